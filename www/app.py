@@ -15,6 +15,7 @@ from jinja2 import Environment, FileSystemLoader
 import orm
 from coroweb import add_routes, add_static
 from handlers import cookie2user, COOKIE_NAME
+from models import Blog, Comment, worker_id
 from config import configs
 
 
@@ -47,6 +48,30 @@ async def logger_factory(app, handler):
 		return (await handler(request))
 	return logger
 
+STICKY_COOKIE_NAME = 'awesticky'
+
+async def sticky_factory(app, handler):
+	# 写操作之后的请求（例如POST之后的重定向）在短时间内继续读主库
+	async def sticky(request):
+		try:
+			orm.stick_to_primary(float(request.cookies.get(STICKY_COOKIE_NAME, 0)))
+		except ValueError:
+			pass
+		before = orm.primary_until()
+		r = await handler(request)
+		until = orm.primary_until()
+		if until > before and isinstance(r, web.StreamResponse) and not r.prepared:
+			r.set_cookie(STICKY_COOKIE_NAME, '%.3f' % until, max_age=max(1, int(until - time.time()) + 1), httponly=True)
+		return r
+	return sticky
+
+async def identity_factory(app, handler):
+	# 同一请求内按主键重复加载的对象直接从identity map中取
+	async def identity(request):
+		with orm.identity_map():
+			return (await handler(request))
+	return identity
+
 async def auth_factory(app, handler):
 	async def auth(request):
 		logging.info('check user: %s %s' % (request.method, request.path))
@@ -74,6 +99,11 @@ async def data_factory(app, handler):
 		return (await handler(request))
 	return parse_data
 
+def json_default(o):
+	if isinstance(o, orm.Model):
+		return dict(o)
+	return o.__dict__
+
 async def response_factory(app, handler):
 	async def response(request):
 		logging.info('Response handler...')
@@ -90,14 +120,26 @@ async def response_factory(app, handler):
 			resp = web.Response(body=r.encode('utf-8'))
 			resp.content_type = 'text/html;charset=utf-8'
 			return resp
+		if isinstance(r, orm.Model):
+			r = dict(r)
 		if isinstance(r, dict):
 			template = r.get('__template__')
 			if template is None:
-				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o:o.__dict__).encode('utf-8'))
+				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
 			else:
 				r['__user__'] = request.__user__
+				if r.get('__stream__'):
+					# 边渲染边发送，长文章不必等整页生成
+					resp = web.StreamResponse()
+					resp.content_type = 'text/html'
+					resp.charset = 'utf-8'
+					await resp.prepare(request)
+					for chunk in app['__templating__'].get_template(template).generate(**r):
+						await resp.write(chunk.encode('utf-8'))
+					await resp.write_eof()
+					return resp
 				resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
 				resp.content_type = 'text/html;charset=utf-8'
 				return resp
@@ -139,10 +181,14 @@ def init(loop):
 	return srv
 '''
 async def init(loop):
+	# 没有WORKER_ID时在启动时就退出，而不是等到第一次生成ID
+	logging.info('worker id: %s' % worker_id())
 	# await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='1qazxsw2', db='awesome')
 	await orm.create_pool(loop=loop, **configs.db)
+	# content列还是文本列时不能写入压缩数据
+	await orm.check_binary_columns([Blog, Comment])
 	app = web.Application(loop=loop, middlewares=[
-		logger_factory, auth_factory, response_factory
+		logger_factory, sticky_factory, identity_factory, auth_factory, response_factory
 	])
 	init_jinja2(app, filters=dict(datetime=datetime_filter))
 	add_routes(app, 'handlers')
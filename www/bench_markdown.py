@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Benchmark markdown2 over generated corpora of blog posts: short and long
+posts, posts heavy on code, tables or links, and Chinese posts. For each
+corpus, report the throughput of markdown2.markdown(), the time spent in
+each pass of Markdown.convert() and the memory peak of a conversion.
+Results can be saved as JSON with --save and compared to a saved run, of
+another commit say, with --compare.
+
+Also times a fresh Markdown instance per document (the old
+markdown2.markdown() behaviour) against the pooled converters, and an older
+copy of markdown2.py given with --baseline; full against incremental
+rendering of a long article after a one-line edit; the memory peak of
+converting it in one piece and block by block; and the nonce placeholders
+against the salted MD5 digests markdown2 used before.
+
+Usage: python3 bench_markdown.py [--baseline path/to/markdown2.py] [--save FILE] [--compare FILE] [posts]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import subprocess
+import tracemalloc
+import importlib.util
+from hashlib import md5
+
+import markdown2
+
+EXTRAS = ['fenced-code-blocks', 'tables']
+
+WORDS = 'the a server request handler pool cache query index latency async await coroutine python mysql blog comment user page template'.split()
+CJK = '数据库连接池缓存索引查询异步协程博客评论用户页面模板性能优化'
+
+def sentence(rnd):
+	words = [rnd.choice(WORDS) for i in range(rnd.randint(6, 18))]
+	i = rnd.randrange(len(words))
+	if rnd.random() < 0.7:
+		words[i] = rnd.choice(('*{0}*', '**{0}**', '`{0}`', '[{0}](http://example.com/{0})')).format(words[i])
+	if rnd.random() < 0.2:
+		words.append(''.join(rnd.choice(CJK) for i in range(rnd.randint(4, 12))))
+	return ' '.join(words).capitalize() + '.'
+
+def cjk_sentence(rnd):
+	# 中文没有空格分词，句子里夹着少量英文和行内格式
+	clauses = [''.join(rnd.choice(CJK) for i in range(rnd.randint(4, 12))) for j in range(rnd.randint(1, 4))]
+	if rnd.random() < 0.5:
+		clauses[-1] += rnd.choice((' *%s* ', '**%s**', '`%s`', '[%s](http://example.com/)')) % rnd.choice(WORDS)
+	return '，'.join(clauses) + '。'
+
+# 以下每个函数生成一篇文章的第i块
+
+def paragraph(rnd, i=0):
+	return ' '.join(sentence(rnd) for j in range(rnd.randint(2, 6)))
+
+def cjk_paragraph(rnd, i=0):
+	return ''.join(cjk_sentence(rnd) for j in range(rnd.randint(2, 8)))
+
+def heading(rnd, i=0):
+	return '## %s' % sentence(rnd).rstrip('.')
+
+def bullets(rnd, i=0):
+	return '\n'.join('%s %s' % (rnd.choice(('-', '*', '1.')), sentence(rnd)) for j in range(rnd.randint(2, 6)))
+
+def code(rnd, i=0):
+	lines = ['def handler_%d(request):' % rnd.randint(0, 99), '\tusers = await User.findAll(\'email=?\', [request.email])', '\tif not users:', '\t\treturn {\'error\': 1 < 2 and "a & b"}', '\treturn users[0]']
+	if rnd.random() < 0.5:
+		return '```python\n%s\n```' % '\n'.join(lines)
+	return '\n'.join('    ' + l for l in lines)
+
+def quote(rnd, i=0):
+	return '> %s' % paragraph(rnd)
+
+def table(rnd, i=0):
+	rows = ['| name | count | ratio |', '|:-----|------:|:-----:|']
+	rows.extend('| %s | %d | %.2f |' % (rnd.choice(WORDS), rnd.randint(0, 999), rnd.random()) for j in range(rnd.randint(2, 6)))
+	return '\n'.join(rows)
+
+def reference(rnd, i=0):
+	return 'See [the docs][%d] and <http://example.com/%d>.\n\n[%d]: http://example.com/docs/%d "Docs"' % ((i,) * 4)
+
+def links(rnd, i=0):
+	' sentences with inline, reference and automatic links, then the definitions of the references. '
+	refs = ['%d-%d' % (i, j) for j in range(rnd.randint(1, 4))]
+	text = ' '.join('%s [%s][%s], <http://example.com/%s>' % (sentence(rnd), rnd.choice(WORDS), r, r) for r in refs)
+	return text + '\n\n' + '\n'.join('[%s]: http://example.com/docs/%s "Docs %s"' % (r, r, r) for r in refs)
+
+# 块的种类及其累积概率
+MIXED = [(0.45, paragraph), (0.55, heading), (0.7, bullets), (0.8, code), (0.87, quote), (0.94, table), (1.0, reference)]
+
+# 语料：名称、篇数相对于命令行参数的比例、每篇的块数、块的种类
+CORPORA = [
+	('short', 1.0, (2, 5), MIXED),
+	('long', 0.05, (80, 160), MIXED),
+	('code', 0.5, (6, 16), [(0.3, paragraph), (0.4, heading), (1.0, code)]),
+	('tables', 0.5, (6, 16), [(0.3, paragraph), (0.4, heading), (1.0, table)]),
+	('links', 0.5, (6, 16), [(0.2, paragraph), (0.3, heading), (1.0, links)]),
+	('cjk', 0.5, (6, 16), [(0.6, cjk_paragraph), (0.7, heading), (0.85, bullets), (0.95, code), (1.0, table)])
+]
+
+def post(rnd, blocks=(6, 16), mix=MIXED):
+	text = ['# %s' % sentence(rnd)]
+	for i in range(rnd.randint(*blocks)):
+		kind = rnd.random()
+		for threshold, make in mix:
+			if kind < threshold:
+				text.append(make(rnd, i))
+				break
+	return '\n\n'.join(text)
+
+def corpus(n, seed=2015):
+	' n posts of the mixed kind. '
+	rnd = random.Random(seed)
+	return [post(rnd) for i in range(n)]
+
+def corpora(n, seed=2015):
+	' [(name, posts)] of every corpus in CORPORA, for n posts on the command line. '
+	result = []
+	for name, share, blocks, mix in CORPORA:
+		rnd = random.Random('%s-%s' % (seed, name))
+		result.append((name, [post(rnd, blocks, mix) for i in range(max(1, int(n * share)))]))
+	return result
+
+def load(path):
+	spec = importlib.util.spec_from_file_location('markdown2_baseline', path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def fresh(texts, module=markdown2):
+	return [module.Markdown(extras=EXTRAS).convert(t) for t in texts]
+
+def pooled(texts):
+	return [markdown2.markdown(t, extras=EXTRAS) for t in texts]
+
+# Markdown.convert()的各个步骤，计时不含其中嵌套调用的其他步骤
+PASSES = ['convert', '_normalize', '_hash_raw_blocks', '_strip_link_definitions', '_run_block_gamut', '_do_headers', '_do_lists', '_do_code_blocks', '_do_fenced_code_blocks', '_do_block_quotes', '_do_tables', '_form_paragraphs', '_run_span_gamut', '_do_code_spans', '_escape_special_chars', '_do_links', '_do_auto_links', '_encode_amps_and_angles', '_do_italics_and_bold', '_finish']
+
+class Timed(markdown2.Markdown):
+	' a converter that adds the time spent in each pass of PASSES to self.times. '
+
+	def __init__(self, **kw):
+		super().__init__(**kw)
+		self.times = dict.fromkeys(PASSES, 0.0)
+		self._nested = []
+
+def _timed(name):
+	method = getattr(markdown2.Markdown, name)
+	def timed(self, *args, **kw):
+		nested = self._nested
+		nested.append(0.0)
+		start = time.perf_counter()
+		try:
+			return method(self, *args, **kw)
+		finally:
+			elapsed = time.perf_counter() - start
+			self.times[name] += elapsed - nested.pop()
+			if nested:
+				nested[-1] += elapsed
+	return timed
+
+for name in PASSES:
+	setattr(Timed, name, _timed(name))
+
+def pass_times(texts, repeat=3):
+	' {pass: seconds per document}, the fastest of repeat runs for each pass. '
+	best = {}
+	for i in range(repeat):
+		converter = Timed(extras=EXTRAS)
+		for t in texts:
+			converter.convert(t)
+		for name, t in converter.times.items():
+			best[name] = min(best.get(name, t), t)
+	return dict((name, t / len(texts)) for name, t in best.items())
+
+class Recorder(markdown2.Markdown):
+	' a converter that records the strings it replaces with placeholders. '
+
+	def __init__(self, **kw):
+		super().__init__(**kw)
+		self.hidden = []
+
+	def _hash_text(self, s):
+		self.hidden.append(s)
+		return super()._hash_text(s)
+
+def hidden_strings(texts):
+	recorder = Recorder(extras=EXTRAS)
+	strings = []
+	for t in texts:
+		recorder.convert(t)
+		strings.append(recorder.hidden)
+		recorder.hidden = []
+	return strings
+
+def md5_placeholders(strings, salt=b'%d' % random.randint(0, 1000000)):
+	for doc in strings:
+		[('md5-' + md5(salt + s.encode('utf-8')).hexdigest()) for s in doc]
+
+def nonce_placeholders(strings):
+	converter = markdown2.Markdown()
+	for doc in strings:
+		# what reset() does for the placeholders of a new conversion
+		converter._nonce = markdown2._nonce()
+		converter._placeholders = {}
+		[converter._hash_text(s) for s in doc]
+
+def edits(article, n):
+	' n versions of article, each with one more word changed in a random paragraph. '
+	rnd = random.Random(n)
+	blocks = article.split('\n\n')
+	versions = []
+	for i in range(n):
+		j = rnd.randrange(len(blocks))
+		blocks[j] = blocks[j].replace(' ', ' edited ', 1)
+		versions.append('\n\n'.join(blocks))
+	return versions
+
+def full(versions):
+	return [markdown2.markdown(t, extras=EXTRAS) for t in versions]
+
+def incremental(versions):
+	return [markdown2.markdown_incremental(t, extras=EXTRAS) for t in versions]
+
+def peak(fn, *args):
+	tracemalloc.start()
+	fn(*args)
+	size = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return size
+
+def whole(text):
+	markdown2.Markdown(extras=EXTRAS).convert(text)
+
+def streamed(text):
+	for html in markdown2.Markdown(extras=EXTRAS).convert_iter(text):
+		pass
+
+def best(fn, texts, repeat=5):
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		fn(texts)
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+def commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def bench_corpora(n, results):
+	named = corpora(n)
+	print('%-8s %6s %9s %10s %10s %10s' % ('corpus', 'posts', 'KB', 'ms/post', 'KB/s', 'peak KB'))
+	passes = {}
+	for name, texts in named:
+		size = sum(len(t.encode('utf-8')) for t in texts)
+		pooled(texts)
+		t = best(pooled, texts)
+		results['%s ms/post' % name] = t * 1000 / len(texts)
+		results['%s KB/s' % name] = size / 1024 / t
+		results['%s peak KB' % name] = max(peak(pooled, [text]) for text in texts) / 1024
+		print('%-8s %6d %9.1f %10.3f %10.1f %10.1f' % (name, len(texts), size / 1024, results['%s ms/post' % name], results['%s KB/s' % name], results['%s peak KB' % name]))
+		passes[name] = pass_times(texts)
+	print()
+	print('ms/post by pass' + ' ' * 18 + ''.join('%9s' % name for name, texts in named))
+	for p in PASSES:
+		print('%-33s%s' % (p, ''.join('%9.3f' % (passes[name][p] * 1000) for name, texts in named)))
+		for name, texts in named:
+			results['%s %s ms/post' % (name, p)] = passes[name][p] * 1000
+
+def compare(results, path, threshold=5.0):
+	' print the results that changed by more than threshold percent since the run saved in path. '
+	with open(path) as f:
+		old = json.load(f)
+	print('compared with %s (commit %s), changes over %.0f%%:' % (path, old['commit'], threshold))
+	changed = False
+	for key, value in results.items():
+		before = old['results'].get(key)
+		if not before or not value:
+			continue
+		change = (value - before) * 100.0 / before
+		if abs(change) >= threshold:
+			changed = True
+			print('  %-48s %10.3f -> %10.3f  %+6.1f%%' % (key, before, value, change))
+	if not changed:
+		print('  no changes.')
+
+def main():
+	args = sys.argv[1:]
+	options = dict(baseline=None, save=None, compare=None)
+	for option in list(options):
+		if '--' + option in args:
+			i = args.index('--' + option)
+			options[option] = args[i + 1]
+			del args[i:i + 2]
+	runs = [('fresh', fresh), ('pooled', pooled)]
+	if options['baseline']:
+		baseline = load(options['baseline'])
+		runs.insert(0, ('baseline', lambda texts: fresh(texts, baseline)))
+	n = int(args[0]) if args else 200
+	results = {}
+	bench_corpora(n, results)
+	print()
+	texts = corpus(n)
+	expected = pooled(texts)
+	for name, fn in runs:
+		if fn(texts) != expected:
+			print('warning: %s output differs' % name)
+	size = sum(map(len, texts))
+	print('%d mixed posts, %.1f KB of markdown' % (n, size / 1024))
+	for name, fn in runs:
+		t = best(fn, texts)
+		results['%s ms/post' % name] = t * 1000 / n
+		print('%-8s %.3f ms/post  %.1f KB/s' % (name, t * 1000 / n, size / 1024 / t))
+	article = '\n\n'.join(texts[:20])
+	versions = edits(article, 20)
+	assert full(versions) == incremental(versions)
+	print('%.1f KB article, one edit per conversion' % (len(article) / 1024))
+	for name, fn in (('full', full), ('incremental', incremental)):
+		t = best(fn, versions)
+		results['%s ms/edit' % name] = t * 1000 / len(versions)
+		print('%-11s %.3f ms/edit' % (name, t * 1000 / len(versions)))
+	for name, fn in (('convert', whole), ('convert_iter', streamed)):
+		results['%s peak KB' % name] = peak(fn, article) / 1024
+		print('%-12s peak %.1f KB' % (name, results['%s peak KB' % name]))
+	strings = hidden_strings(texts)
+	count = sum(map(len, strings))
+	print('%d placeholders, %.1f per post' % (count, count / n))
+	for name, fn in (('md5', md5_placeholders), ('nonce', nonce_placeholders)):
+		t = best(fn, strings)
+		print('%-8s %.3f us/placeholder' % (name, t * 1e6 / count))
+	if options['compare']:
+		print()
+		compare(results, options['compare'])
+	if options['save']:
+		with open(options['save'], 'w') as f:
+			json.dump(dict(commit=commit(), python=platform.python_version(), posts=n, results=results), f, indent=1, sort_keys=True)
+		print('saved to %s' % options['save'])
+
+
+if __name__ == '__main__':
+	main()
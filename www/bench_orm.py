@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Micro-benchmarks of the orm Model layer. No database is needed, rows are
+generated in memory and fed to the same code paths findAll() uses.
+
+Usage: python3 bench_orm.py [rows]
+'''
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from models import Blog
+
+class LegacyBlog(dict):
+	'''
+	The dict based Model layout used before, kept here as the baseline.
+	'''
+
+	def __init__(self, **kw):
+		super(LegacyBlog, self).__init__(**kw)
+
+	def __getattr__(self, key):
+		try:
+			return self[key]
+		except KeyError:
+			raise AttributeError(r"'Model' object has no attribute '%s'" % key)
+
+	def __setattr__(self, key, value):
+		self[key] = value
+
+	def getValue(self, key):
+		return getattr(self, key, None)
+
+	def getValueOrDefault(self, key):
+		value = getattr(self, key, None)
+		if value is None:
+			field = Blog.__mappings__[key]
+			if field.default is not None:
+				value = field.default() if callable(field.default) else field.default
+				setattr(self, key, value)
+		return value
+
+	def insert_args(self):
+		args = list(map(self.getValueOrDefault, Blog.__fields__))
+		args.append(self.getValueOrDefault(Blog.__primary_key__))
+		return args
+
+	def update_args(self):
+		args = list(map(self.getValue, Blog.__fields__))
+		args.append(self.getValue(Blog.__primary_key__))
+		return args
+
+# 各字段的样本值，没有列出的字段取None
+VALUES = dict(
+	id=lambda i: '%015d%s000' % (i, 'f' * 32),
+	user_id=lambda i: 'u%d' % (i % 100),
+	user_name=lambda i: 'user',
+	user_image=lambda i: 'about:blank',
+	name=lambda i: 'blog %d' % i,
+	summary=lambda i: 'summary',
+	content=lambda i: 'content',
+	toc=lambda i: [[1, 'intro', 'Intro']],
+	created_at=lambda i: 1500000000.0 + i
+)
+
+def make_rows(n):
+	' n blogs as dicts with the fields of Blog.__slots__ in column order. '
+	return [dict((f, VALUES[f](i) if f in VALUES else None) for f in Blog.__slots__) for i in range(n)]
+
+def db_row(r):
+	' the tuple a select returns for the blog r, with the values as stored. '
+	mappings = Blog.__mappings__
+	return tuple(mappings[f].to_db(v) if mappings[f].to_db else v for f, v in r.items())
+
+def rss():
+	' resident set size in bytes, or None if /proc is not available. '
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		return None
+
+def timeit(fn, *args):
+	gc.collect()
+	start = time.perf_counter()
+	fn(*args)
+	return time.perf_counter() - start
+
+def construct(cls, rows):
+	return [cls(**r) for r in rows]
+
+def decode(cls, rows):
+	return list(map(cls.__from_row__, rows))
+
+def access(objs):
+	for o in objs:
+		o.id, o.name, o.summary, o.created_at, o.content
+
+def write_args(objs):
+	for o in objs:
+		o.insert_args() if isinstance(o, LegacyBlog) else o.__insert_args__()
+		o.update_args() if isinstance(o, LegacyBlog) else o.__update_args__()
+
+def memory(cls, rows):
+	gc.collect()
+	before_rss = rss()
+	tracemalloc.start()
+	objs = construct(cls, rows)
+	allocated = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	after_rss = rss()
+	del objs
+	return allocated, (after_rss - before_rss) if before_rss is not None else None
+
+def bench(cls, rows):
+	per = 100000 / len(rows)
+	objs = construct(cls, rows)
+	allocated, grown = memory(cls, rows)
+	results = [
+		('construct', '%.1f ms' % (timeit(construct, cls, rows) * per * 1000)),
+		('access', '%.1f ms' % (timeit(access, objs) * per * 1000)),
+		('save+update args', '%.1f ms' % (timeit(write_args, objs) * per * 1000)),
+		('allocated', '%.1f MB' % (allocated * per / 1e6)),
+		('rss', '%.1f MB' % (grown * per / 1e6) if grown is not None else 'n/a')
+	]
+	if hasattr(cls, '__from_row__'):
+		# findAll()的实际路径：tuple行直接解码
+		tuples = [db_row(r) for r in rows]
+		results.insert(1, ('from_row', '%.1f ms' % (timeit(decode, cls, tuples) * per * 1000)))
+	return results
+
+def main():
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	rows = make_rows(n)
+	print('%d rows, figures scaled to 100k rows' % n)
+	for cls in (LegacyBlog, Blog):
+		print('%-12s %s' % (cls.__name__, '  '.join('%s: %s' % r for r in bench(cls, rows))))
+
+
+if __name__ == '__main__':
+	main()
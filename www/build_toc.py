@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Compute the stored table of contents of the blogs saved before the `toc`
+column existed. Run sync_schema.py --apply first to add the column; until
+a blog has its table of contents, its page shows none.
+
+Usage: python3 build_toc.py [--apply]
+'''
+
+import sys
+import asyncio
+
+import orm
+from models import Blog
+from handlers import blog_toc
+from config import configs
+
+BATCH = 200
+
+async def build(loop, apply):
+	await orm.create_pool(loop=loop, **configs.db)
+	built = 0
+	last = ''
+	async with orm.connection():
+		while True:
+			blogs = await Blog.findAll('`id`>? and `toc`=?', [last, ''], orderBy='id', limit=BATCH)
+			if not blogs:
+				break
+			last = blogs[-1].id
+			for blog in blogs:
+				built += 1
+				if apply:
+					await Blog.update_where(blog.id, toc=blog_toc(blog.content))
+	print('%s blogs without a table of contents.' % built)
+	if built and not apply:
+		print('run with --apply to compute them.')
+
+
+if __name__ == '__main__':
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(build(loop, '--apply' in sys.argv[1:]))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Bounded LRU caches with hit/miss counters, shared by markdown2, orm and handlers.
+'''
+
+import threading
+import functools
+from collections import OrderedDict
+
+# 所有命名的缓存，供stats()和clear_all()使用
+_registry = {}
+_registry_lock = threading.Lock()
+
+class LRUCache(object):
+	'''
+	A thread-safe LRU mapping holding at most size entries. Caches created
+	with a name are listed by stats() and emptied by clear_all().
+	'''
+
+	def __init__(self, size=128, name=None):
+		self.size = size
+		self.name = name
+		self.hits = self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		if name is not None:
+			with _registry_lock:
+				_registry[name] = self
+
+	def get(self, key, default=None):
+		with self._lock:
+			try:
+				value = self._entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			self._entries[key] = value
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = value
+			while len(self._entries) > self.size:
+				self._entries.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.hits = self.misses = 0
+
+	def stats(self):
+		return dict(name=self.name, size=self.size, entries=len(self._entries), hits=self.hits, misses=self.misses)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __repr__(self):
+		return '<LRUCache %s: %s/%s, %s hits, %s misses>' % (self.name, len(self._entries), self.size, self.hits, self.misses)
+
+_missing = object()
+
+def memoize(size=128, name=None):
+	'''
+	Decorator caching the results of a function of positional arguments in an
+	LRUCache, exposed as fn.cache. Calls with unhashable arguments are not cached.
+	'''
+	def decorator(fn):
+		cache = LRUCache(size, name or '%s.%s' % (fn.__module__, fn.__name__))
+		@functools.wraps(fn)
+		def wrapper(*args):
+			try:
+				value = cache.get(args, _missing)
+			except TypeError:
+				return fn(*args)
+			if value is _missing:
+				value = fn(*args)
+				cache.put(args, value)
+			return value
+		wrapper.cache = cache
+		return wrapper
+	return decorator
+
+def stats():
+	' the counters of every named cache, sorted by name. '
+	with _registry_lock:
+		caches = list(_registry.values())
+	return sorted((c.stats() for c in caches), key=lambda s: s['name'])
+
+def clear_all():
+	with _registry_lock:
+		caches = list(_registry.values())
+	for c in caches:
+		c.clear()
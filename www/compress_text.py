@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Convert the `content` columns of blogs and comments from mediumtext to
+mediumblob and rewrite the legacy rows in the CompressedTextField format.
+Legacy rows are readable right after the column change, so the site can keep
+running while the rows are rewritten batch by batch.
+
+Run it before deploying the code that stores compressed text: app.py
+refuses to start while a column is still a text column.
+
+Usage: python3 compress_text.py [--apply]
+'''
+
+import sys
+import asyncio
+
+import orm
+from models import Blog, Comment
+from config import configs
+
+BATCH = 200
+
+async def column_type(table, column):
+	rs = await orm.select('select data_type from information_schema.columns where table_schema=database() and table_name=? and column_name=?', [table, column], tuples=True)
+	return rs[0][0] if rs else None
+
+def is_legacy(field, value):
+	' a row written before the conversion carries no format marker. '
+	return value is not None and value[:1] not in (field.RAW, field.ZLIB)
+
+async def compress(cls, apply):
+	field = cls.__mappings__['content']
+	if await column_type(cls.__table__, 'content') != field.column_type:
+		print('%s: alter table `%s` modify `content` %s not null;' % (cls.__table__, cls.__table__, field.column_type))
+		if not apply:
+			return
+		await orm.execute('alter table `%s` modify `content` %s not null' % (cls.__table__, field.column_type), None)
+	before = after = rewritten = 0
+	last = ''
+	while True:
+		rs = await orm.select('select `id`, `content` from `%s` where `id`>? order by `id` limit ?' % cls.__table__, [last, BATCH], tuples=True)
+		if not rs:
+			break
+		last = rs[-1][0]
+		for pk, value in rs:
+			if not is_legacy(field, value):
+				continue
+			data = field.to_db(bytes(value).decode('utf-8'))
+			before += len(value)
+			after += len(data)
+			rewritten += 1
+			if apply:
+				await orm.execute('update `%s` set `content`=? where `id`=?' % cls.__table__, [data, pk])
+	print('%s: %s legacy rows, %s bytes -> %s bytes.' % (cls.__table__, rewritten, before, after))
+
+async def main(loop, apply):
+	await orm.create_pool(loop=loop, **configs.db)
+	async with orm.connection():
+		for cls in (Blog, Comment):
+			await compress(cls, apply)
+	if not apply:
+		print('run with --apply to rewrite them.')
+
+
+if __name__ == '__main__':
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(main(loop, '--apply' in sys.argv[1:]))
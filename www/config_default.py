@@ -10,7 +10,12 @@ configs = {
 		'port': 3306,
 		'user': 'root',
 		'password': '1qazxsw2',
-		'database': 'awesome'
+		'database': 'awesome',
+		'minsize': 1,
+		'maxsize': 10,
+		'adaptive': False,
+		'replicas': [],
+		'advisor': False
 	},
 	'session': {
 		'secret': 'Awesome'
@@ -14,15 +14,25 @@ import base64
 import asyncio
 from aiohttp import web
 
-import markdown2
+import orm
+from cache import memoize
 from coroweb import get, post
 from apis import APIValueError, APIResourceNotFoundError, APIError, Page,APIPermissionError
-from models import User, Comment, Blog, next_id
+from models import User, Comment, Blog, LegacyBlogId, next_id, ID_LENGTH
 from config import configs
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 
+# 超过这个长度的文章边转换边发送
+STREAM_THRESHOLD = 32 * 1024
+
+# 博客页面每页显示的评论数
+COMMENTS_PER_PAGE = 50
+
+# 正文的标题带id，作为目录的锚点
+BLOG_EXTRAS = ['header-ids']
+
 def check_admin(request):
 	if request.__user__ is None or not request.__user__.admin:
 		raise APIPermissionError()
@@ -37,6 +47,20 @@ def get_page_index(page_str):
 		p = 1
 	return p
 
+def get_comments_cursor(before):
+	'''
+	Parse the `before` argument of a blog page, "created_at_id" of the last
+	comment of the previous page, or return None for the newest comments.
+	'''
+	try:
+		created_at, cid = before.split('_', 1)
+		return float(created_at), cid
+	except ValueError:
+		return None
+
+def comments_cursor(comment):
+	return '%r_%s' % (comment.created_at, comment.id)
+
 # 计算加密cookie
 def user2cookie(user, max_age):
 	'''
@@ -48,6 +72,24 @@ def user2cookie(user, max_age):
 	L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
 	return '-'.join(L)
 
+def blog_toc(content):
+	'''
+	Extract the table of contents of a blog as [level, id, name] entries, when
+	the blog is saved. The ids are the ones BLOG_EXTRAS gives the headers.
+	'''
+	import markdown2
+	toc = markdown2.markdown(content, extras=['toc'])._toc
+	return [list(entry) for entry in toc or ()]
+
+def toc_html(toc):
+	' the HTML of a stored table of contents, None if the blog has no headers. '
+	if not toc:
+		return None
+	import markdown2
+	return markdown2.calculate_toc_html(toc)
+
+# 评论的HTML在写入时生成，旧评论在浏览时转换
+@memoize(4096)
 def text2html(text):
 	lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
 	return ''.join(lines)
@@ -73,6 +115,7 @@ async def cookie2user(cookie_str):
 		if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
 			logging.info('invalid sha1')
 			return None
+		orm.detach(user)
 		user.passwd = '******'
 		return user
 	except Exception as e:
@@ -103,16 +146,44 @@ async def index(request):
 	}
 
 @get('/blog/{id}')
-async def get_blog(id):
-	blog = await Blog.find(id)
-	comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+async def get_blog(id, *, before=''):
+	cursor = get_comments_cursor(before)
+	async with orm.connection(readonly=True):
+		blog = await Blog.find(id)
+		if blog is None:
+			# migrate_ids.py迁移后的旧ID永久重定向到新ID；迁移前旧ID仍在blogs表中，上面已经找到
+			legacy = await LegacyBlogId.find(id) if len(id) > ID_LENGTH else None
+			if legacy is None:
+				return web.HTTPNotFound()
+			return web.HTTPMovedPermanently('/blog/%s' % legacy.blog_id)
+		# 按(created_at, id)定位上一页的最后一条评论，多取一条判断是否还有下一页
+		if cursor is None:
+			comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc, id desc', limit=COMMENTS_PER_PAGE + 1)
+		else:
+			comments = await Comment.findAll('blog_id=? and (created_at<? or (created_at=? and id<?))', [id, cursor[0], cursor[0], cursor[1]], orderBy='created_at desc, id desc', limit=COMMENTS_PER_PAGE + 1)
+	older = None
+	if len(comments) > COMMENTS_PER_PAGE:
+		comments = comments[:COMMENTS_PER_PAGE]
+		older = comments_cursor(comments[-1])
 	for c in comments:
-		c.html_content = text2html(c.content)
-	blog.html_content = markdown2.markdown(blog.content)
+		# 写入时已生成HTML，旧评论没有
+		if not c.html_content:
+			c.html_content = text2html(c.content)
+	# markdown2在第一次浏览博客时才加载，不拖慢启动
+	import markdown2
+	stream = len(blog.content) >= STREAM_THRESHOLD
+	if stream:
+		blog.html_chunks = markdown2.markdown_iter(blog.content, extras=BLOG_EXTRAS, cache=markdown2.block_cache)
+	else:
+		blog.html_content = markdown2.markdown_incremental(blog.content, extras=BLOG_EXTRAS)
 	return {
 		'__template__': 'blog.html',
+		'__stream__': stream,
 		'blog': blog,
-		'comments': comments
+		'toc_html': toc_html(blog.toc),
+		'comments': comments,
+		'newest': cursor is None,
+		'older_comments': older
 	}
 
 @get('/api/users')
@@ -176,7 +247,7 @@ async def api_register_user(*, email, name, passwd):
 	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.passwd = '******'
 	r.content_type = 'application/json'
-	r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	r.body = json.dumps(dict(user), ensure_ascii=False).encode('utf-8')
 	return r
 
 @post('/api/authenticate')
@@ -201,7 +272,7 @@ async def authenticate(*, email, passwd):
 	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.passwd = '******'
 	r.content_type = 'application/json'
-	r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	r.body = json.dumps(dict(user), ensure_ascii=False).encode('utf-8')
 	return r
 
 @post('/api/blogs')
@@ -219,7 +290,8 @@ async def api_create_blog(request, *, name, summary, content):
 			user_image=request.__user__.image,
 			name=name.strip(),
 			summary=summary.strip(),
-			content=content.strip()
+			content=content.strip(),
+			toc=blog_toc(content.strip())
 		)
 	await blog.save()
 	return blog
@@ -227,24 +299,25 @@ async def api_create_blog(request, *, name, summary, content):
 @post('/api/blogs/{id}')
 async def api_update_blog(id, request, *, name, summary, content):
 	check_admin(request)
-	blog = await Blog.find(id)
 	if not name or not name.strip():
 		raise APIValueError('name', 'name cannot be empty.')
 	if not summary or not summary.strip():
 		raise APIValueError('summary', 'summary cannot be empty.')
 	if not content or not content.strip():
 		raise APIValueError('content', 'content cannot be empty.')
-	blog.name = name.strip()
-	blog.summary = summary.strip()
-	blog.content = content.strip()
-	await blog.update()
+	fields = dict(name=name.strip(), summary=summary.strip(), content=content.strip(), toc=blog_toc(content.strip()))
+	await Blog.update_where(id, **fields)
+	# 写入后会读主库，返回和以前一样的完整博客；内容未变化时影响行数为0，所以用find()确认博客存在
+	blog = await Blog.find(id)
+	if blog is None:
+		raise APIResourceNotFoundError('Blog')
 	return blog
 
 @post('/api/blogs/{id}/delete')
 async def api_delete_blog(request, *, id):
 	check_admin(request)
-	blog = await Blog.find(id)
-	await blog.remove()
+	if await Blog.delete_by_pk(id) == 0:
+		raise APIResourceNotFoundError('Blog')
 	return dict(id=id)
 
 @get('/api/blogs')
@@ -313,20 +386,19 @@ async def api_create_comment(id, request, *, content):
 		raise APIPermissionError('Please signin first.')
 	if not content or not content.strip():
 		raise APIValueError('content', 'empty!')
-	blog = await Blog.find(id)
-	if blog is None:
-		raise APIResourceNotFoundError('Blog')
-	comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-	await comment.save()
+	async with orm.connection():
+		blog = await Blog.find(id)
+		if blog is None:
+			raise APIResourceNotFoundError('Blog')
+		comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip(), html_content=text2html(content.strip()))
+		await comment.save()
 	return comment
 
 @post('/api/comments/{id}/delete')
 async def api_delete_comments(id, request):
 	check_admin(request)
-	c = await Comment.find(id)
-	if c is None:
+	if await Comment.delete_by_pk(id) == 0:
 		raise APIResourceNotFoundError('Comment', 'Not Found!')
-	await c.remove()
 	return dict(id=id)
 
 
@@ -84,16 +84,14 @@ __author__ = "Trent Mick"
 
 import os
 import sys
-from pprint import pprint, pformat
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
-import optparse
-from random import random, randint
+import threading
+from random import random
+from binascii import hexlify
+from hashlib import sha1
 import codecs
+from cache import LRUCache, memoize
 
 
 #---- Python version compat
@@ -132,13 +130,49 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+class _lazy_re(object):
+    """A regex compiled on first use rather than at import, so that importing
+    this module doesn't compile every pattern of every extra. After the
+    first use, the methods of the compiled pattern are bound straight onto
+    the instance.
+    """
+    _methods = ("match", "search", "sub", "subn", "split", "findall",
+                "finditer", "fullmatch")
+
+    def __init__(self, pattern, flags=0):
+        self._args = (pattern, flags)
+
+    def __getattr__(self, name):
+        # Only called for attributes missing from the instance, i.e.
+        # before the pattern is compiled or for rarely used ones.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        compiled = re.compile(*self._args)
+        for method in self._methods:
+            if hasattr(compiled, method):
+                setattr(self, method, getattr(compiled, method))
+        return getattr(compiled, name)
+
 
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+# Escaped characters, code, HTML blocks and spans are swapped out for
+# placeholders while the rest of the document is processed. A placeholder
+# is a random nonce followed by a counter, 32 hex digits in all: cheap to
+# make, impossible to spell in a document without knowing the nonce, and
+# no placeholder is a prefix of another.
+def _nonce():
+    return hexlify(os.urandom(8)).decode("ascii")
+
+def _placeholder(nonce, n):
+    return "%s%016x" % (nonce, n)
+
+_g_nonce = _nonce()
+
+# Table of placeholders for escaped characters, and for the quotes that
+# the "smarty-pants" extra escapes too:
+g_escape_table = dict([(ch, _placeholder(_g_nonce, i))
+    for i, ch in enumerate('\\`*_{}[]()>#+-.!')])
+g_quote_escape_table = dict([(ch, _placeholder(_g_nonce, len(g_escape_table) + i))
+    for i, ch in enumerate('"\'')])
 
 
 
@@ -158,18 +192,117 @@ def markdown_path(path, encoding="utf-8",
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+    return _pooled_convert(text, html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           use_file_vars=use_file_vars)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+    return _pooled_convert(text, html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           use_file_vars=use_file_vars)
+
+def markdown_iter(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                  safe_mode=None, extras=None, link_patterns=None,
+                  use_file_vars=False, cache=None):
+    """Like `markdown()`, but yield the HTML block by block. See
+    `Markdown.convert_iter()`.
+    """
+    options = dict(html4tags=html4tags, tab_width=tab_width,
+                   safe_mode=safe_mode, extras=extras,
+                   link_patterns=link_patterns, use_file_vars=use_file_vars)
+    converter, idle = _take_converter(options)
+    try:
+        for html in converter.convert_iter(text, cache):
+            yield html
+    finally:
+        _give_back_converter(converter, idle)
+
+def markdown_incremental(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                         safe_mode=None, extras=None, link_patterns=None,
+                         use_file_vars=False, cache=None):
+    """Like `markdown()`, but reuse the HTML of unchanged top-level blocks
+    from `cache` (`block_cache` by default). See
+    `Markdown.convert_incremental()`.
+    """
+    return _pooled_convert(text, html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           use_file_vars=use_file_vars,
+                           _incremental=True, _cache=cache)
+
+
+#---- converter pool
+
+# Idle `Markdown` instances, keyed by their constructor options, so that
+# `markdown()` doesn't pay for building a converter on every call. A
+# converter is taken out of the pool for the whole of one `convert()` call,
+# so it is never used by two threads at once, and `convert()` never yields
+# to an event loop, so coroutines can't interleave on one either. Only
+# the most recently used option sets keep their converters.
+POOL_SIZE = 8
+_pool = LRUCache(size=32, name='markdown2.pool')
+_pool_lock = threading.Lock()
+
+def _freeze(value):
+    """Hashable version of an option value: dicts and lists to tuples."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    return value
+
+def _options_key(**options):
+    if options["extras"] is not None and not isinstance(options["extras"], dict):
+        options["extras"] = dict([(e, None) for e in options["extras"]])
+    return _freeze(options)
+
+def _take_converter(options):
+    """A converter for `options` from the pool or a new one, and the pool
+    list to give it back to (None if the options can't be pooled).
+    """
+    try:
+        key = _options_key(**options)
+        with _pool_lock:
+            idle = _pool.get(key)
+            if idle is None:
+                idle = []
+                _pool.put(key, idle)
+            if idle:
+                return idle.pop(), idle
+    except TypeError:
+        # uncachable -- for instance, an extra argument that is a set.
+        idle = None
+    return Markdown(**options), idle
+
+def _give_back_converter(converter, idle):
+    if idle is None:
+        return
+    with _pool_lock:
+        if len(idle) < POOL_SIZE:
+            idle.append(converter)
+
+def _pooled_convert(text, _incremental=False, _cache=None, **options):
+    converter, idle = _take_converter(options)
+    try:
+        if _incremental:
+            return converter.convert_incremental(text, _cache)
+        return converter.convert(text)
+    finally:
+        _give_back_converter(converter, idle)
+
+
+#---- caches
+
+# Rendered HTML of blocks, see `Markdown.convert_incremental()`.
+block_cache = LRUCache(size=2048, name='markdown2.blocks')
+
+# Highlighted code of fenced code blocks, see `_color_with_pygments()`.
+highlight_cache = LRUCache(size=512, name='markdown2.highlight')
+
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -190,7 +323,7 @@ class Markdown(object):
     # (see _ProcessListItems() for details):
     list_level = 0
 
-    _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _ws_only_line_re = _lazy_re(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
                  extras=None, link_patterns=None, use_file_vars=False):
@@ -224,12 +357,26 @@ class Markdown(object):
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+        # Everything the HTML of a block depends on, see `convert_incremental()`.
+        self._options_key = _freeze((self.__class__, self.empty_element_suffix,
+            tab_width, self.safe_mode, self._instance_extras, link_patterns))
+        self._outdent_re = _outdent_re_from_tab_width(tab_width)
 
-        self._escape_table = g_escape_table.copy()
+        self._instance_escape_table = g_escape_table.copy()
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._instance_escape_table.update(g_quote_escape_table)
+        self._escape_table = self._instance_escape_table.copy()
+
+    def _hash_text(self, s):
+        """Return the placeholder for `s`, the same one for the same text
+        throughout a conversion.
+        """
+        try:
+            return self._placeholders[s]
+        except KeyError:
+            key = self._placeholders[s] = _placeholder(self._nonce,
+                                                       len(self._placeholders))
+            return key
 
     def reset(self):
         self.urls = {}
@@ -238,6 +385,12 @@ class Markdown(object):
         self.html_spans = {}
         self.list_level = 0
         self.extras = self._instance_extras.copy()
+        # `_encode_code()` adds an entry per code span, don't let them pile
+        # up in a reused converter.
+        self._escape_table = self._instance_escape_table.copy()
+        self._toc = None
+        self._nonce = _nonce()
+        self._placeholders = {}
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -248,7 +401,9 @@ class Markdown(object):
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
-    _a_nofollow = re.compile(r"<(a)([^>]*href=)", re.IGNORECASE)
+    _a_nofollow = _lazy_re(r"<(a)([^>]*href=)", re.IGNORECASE)
+    _newline_re = _lazy_re("\r\n|\r")
+    _extras_splitter_re = _lazy_re("[ ,]+")
 
     def convert(self, text):
         """Convert the given text."""
@@ -271,8 +426,7 @@ class Markdown(object):
             # Look for emacs-style file variable hints.
             emacs_vars = self._get_emacs_vars(text)
             if "markdown-extras" in emacs_vars:
-                splitter = re.compile("[ ,]+")
-                for e in splitter.split(emacs_vars["markdown-extras"]):
+                for e in self._extras_splitter_re.split(emacs_vars["markdown-extras"]):
                     if '=' in e:
                         ename, earg = e.split('=', 1)
                         try:
@@ -283,8 +437,43 @@ class Markdown(object):
                         ename, earg = e, None
                     self.extras[ename] = earg
 
+        text = self._normalize(text)
+
+        # strip metadata from head and extract
+        if "metadata" in self.extras:
+            text = self._extract_metadata(text)
+
+        text = self.preprocess(text)
+
+        text = self._hash_raw_blocks(text)
+
+        # Strip link definitions, store in hashes.
+        if "footnotes" in self.extras:
+            # Must do footnotes first because an unlucky footnote defn
+            # looks like a link defn:
+            #   [^4]: this "looks like a link defn"
+            text = self._strip_footnote_definitions(text)
+        text = self._strip_link_definitions(text)
+
+        text = self._run_block_gamut(text)
+
+        if "footnotes" in self.extras:
+            text = self._add_footnotes(text)
+
+        text = self._finish(text)
+
+        text += "\n"
+
+        rv = UnicodeWithAttrs(text)
+        if "toc" in self.extras:
+            rv._toc = self._toc
+        if "metadata" in self.extras:
+            rv.metadata = self.metadata
+        return rv
+
+    def _normalize(self, text):
         # Standardize line endings:
-        text = re.sub("\r\n|\r", "\n", text)
+        text = self._newline_re.sub("\n", text)
 
         # Make sure $text ends with a couple of newlines:
         text += "\n\n"
@@ -296,14 +485,9 @@ class Markdown(object):
         # This makes subsequent regexen easier to write, because we can
         # match consecutive blank lines with /\n+/ instead of something
         # contorted like /[ \t]*\n+/ .
-        text = self._ws_only_line_re.sub("", text)
-
-        # strip metadata from head and extract
-        if "metadata" in self.extras:
-            text = self._extract_metadata(text)
-
-        text = self.preprocess(text)
+        return self._ws_only_line_re.sub("", text)
 
+    def _hash_raw_blocks(self, text):
         if "fenced-code-blocks" in self.extras and not self.safe_mode:
             text = self._do_fenced_code_blocks(text)
 
@@ -315,20 +499,9 @@ class Markdown(object):
 
         if "fenced-code-blocks" in self.extras and self.safe_mode:
             text = self._do_fenced_code_blocks(text)
+        return text
 
-        # Strip link definitions, store in hashes.
-        if "footnotes" in self.extras:
-            # Must do footnotes first because an unlucky footnote defn
-            # looks like a link defn:
-            #   [^4]: this "looks like a link defn"
-            text = self._strip_footnote_definitions(text)
-        text = self._strip_link_definitions(text)
-
-        text = self._run_block_gamut(text)
-
-        if "footnotes" in self.extras:
-            text = self._add_footnotes(text)
-
+    def _finish(self, text):
         text = self.postprocess(text)
 
         text = self._unescape_special_chars(text)
@@ -338,16 +511,211 @@ class Markdown(object):
 
         if "nofollow" in self.extras:
             text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
+        return text
 
-        text += "\n"
+    def convert_incremental(self, text, cache=None):
+        """Convert the given text like `convert()`, but render each top-level
+        block on its own and take the HTML of blocks seen before from
+        `cache` (a `cache.LRUCache`, the module's `block_cache` by default).
+        Re-rendering an edited document only costs the changed blocks.
 
-        rv = UnicodeWithAttrs(text)
+        Documents that need whole-document passes (the "footnotes" and
+        "metadata" extras, file variables) are converted in full.
+        """
+        if ("footnotes" in self.extras or "metadata" in self.extras
+                or self.use_file_vars or not self._cachable()):
+            return self.convert(text)
+        if cache is None:
+            cache = block_cache
+        rv = UnicodeWithAttrs("".join(self._convert_blocks(text, cache)))
         if "toc" in self.extras:
             rv._toc = self._toc
-        if "metadata" in self.extras:
-            rv.metadata = self.metadata
         return rv
 
+    def convert_iter(self, text, cache=None):
+        """Convert the given text like `convert()`, but yield the HTML one
+        top-level block at a time, so that a long document can be sent
+        while it is converted. Link and footnote definitions are collected
+        in a first, cheap pass over the document. The pieces join to what
+        `convert()` returns, except that there is no `toc_html`.
+
+        Blocks are taken from and added to `cache` like in
+        `convert_incremental()`, if one is given and the document doesn't
+        use footnotes. With the "metadata" extra or file variables the
+        document is converted in full and yielded at once.
+        """
+        if "metadata" in self.extras or self.use_file_vars:
+            yield self.convert(text)
+            return
+        if "footnotes" in self.extras or not self._cachable():
+            cache = None
+        for html in self._convert_blocks(text, cache):
+            yield html
+
+    def _cachable(self):
+        try:
+            hash(self._options_key)
+        except TypeError:
+            # uncachable -- for instance, an extra argument that is a set.
+            return False
+        return True
+
+    def _convert_blocks(self, text, cache):
+        self.reset()
+
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        text = self.preprocess(self._normalize(text))
+        blocks = self._split_blocks(text)
+        del text
+
+        # Link and footnote definitions apply to the whole document:
+        # collect them first.
+        for block in blocks:
+            if '[' not in block:
+                continue
+            key = ("definitions", self._options_key, block)
+            definitions = cache is not None and cache.get(key) or None
+            if definitions is None:
+                definitions = self._block_definitions(block)
+                if cache is not None:
+                    cache.put(key, definitions)
+            urls, titles, footnotes = definitions
+            self.urls.update(urls)
+            self.titles.update(titles)
+            if footnotes:
+                self.footnotes.update(footnotes)
+        link_context = (tuple(sorted(self.urls.items())),
+                        tuple(sorted(self.titles.items())))
+
+        empty = True
+        for block in blocks:
+            if cache is None:
+                html = self._render_block(block)
+            else:
+                html = self._cached_block(block, cache, link_context)
+            if html:
+                yield empty and html or "\n\n" + html
+                empty = False
+        if empty:
+            yield "<p></p>"  # what convert() makes of an empty document
+        if "footnotes" in self.extras:
+            footer = self._add_footnotes("")
+            if footer:
+                yield self._finish(footer)
+        yield "\n"
+
+    def _render_block(self, block):
+        text = self._hash_raw_blocks(block)
+        # Strip the definitions, but keep the document's: a later
+        # definition of the same id wins.
+        state = self.urls, self.titles, getattr(self, "footnotes", None)
+        self.urls, self.titles, self.footnotes = {}, {}, {}
+        try:
+            if "footnotes" in self.extras:
+                text = self._strip_footnote_definitions(text)
+            text = self._strip_link_definitions(text)
+        finally:
+            self.urls, self.titles, self.footnotes = state
+        if not text.strip():
+            # nothing but definitions
+            return ""
+        return self._finish(self._run_block_gamut(text))
+
+    def _cached_block(self, block, cache, link_context):
+        # Header ids depend on the headers before: a block that may have
+        # one is keyed by, and replays, the id counts.
+        headers = ("header-ids" in self.extras
+                   and self._header_hint_re.search(block) is not None)
+        key = ("html", self._options_key, block,
+               '[' in block and link_context or None,
+               headers and tuple(sorted(self._count_from_header_id.items())) or None)
+        rendered = cache.get(key)
+        if rendered is None:
+            toc_start = self._toc and len(self._toc) or 0
+            rendered = (self._render_block(block),
+                        headers and dict(self._count_from_header_id) or None,
+                        tuple((self._toc or [])[toc_start:]))
+            cache.put(key, rendered)
+        else:
+            if rendered[1] is not None:
+                self._count_from_header_id = dict(rendered[1])
+            if rendered[2]:
+                if self._toc is None:
+                    self._toc = []
+                self._toc.extend(rendered[2])
+        return rendered[0]
+
+    _header_hint_re = _lazy_re(r"#|^[ \t>]*[=-]+[ \t]*$", re.M)
+    _block_html_tag_re = _lazy_re(r"<(\w+)")
+    _list_marker_re = _lazy_re(r"(?:[*+-]|\d+\.)[ \t]")
+
+    def _split_blocks(self, text):
+        """Split normalized text into top-level blocks that can be rendered
+        independently: only at blank lines followed by an unindented line
+        that doesn't start a list item, a block quote, an HTML tag or a
+        definition (whose removal could join the blocks around it), and
+        never inside a fenced code block, an HTML block or a comment.
+        """
+        blocks = []
+        lines = []
+        blanks = 0
+        fence = False
+        closer = None   # closing tag of an open HTML block or comment
+        for line in text.split("\n"):
+            if not line:
+                if lines:
+                    blanks += 1
+                continue
+            if (blanks and not fence and closer is None
+                    and line[0] not in " \t><["
+                    and not self._list_marker_re.match(line)):
+                blocks.append("\n".join(lines) + "\n\n")
+                lines = []
+            else:
+                lines.extend([""] * blanks)
+            blanks = 0
+            lines.append(line)
+            if line.startswith("```"):
+                fence = not fence
+            elif fence:
+                pass
+            elif closer is not None:
+                if closer in line:
+                    closer = None
+            elif line.startswith("<!--"):
+                if "-->" not in line:
+                    closer = "-->"
+            elif line.startswith("<"):
+                m = self._block_html_tag_re.match(line)
+                if m and ("</%s>" % m.group(1)) not in line:
+                    closer = "</%s>" % m.group(1)
+        if lines:
+            blocks.append("\n".join(lines) + "\n\n")
+        return blocks
+
+    def _block_definitions(self, block):
+        """The link and footnote definitions convert() would strip from
+        `block`, as (id, url), (id, title) and (id, footnote) tuples.
+        """
+        state = (self.urls, self.titles, self.html_blocks, self.html_spans,
+                 getattr(self, "footnotes", None))
+        self.urls, self.titles, self.html_blocks, self.html_spans = {}, {}, {}, {}
+        self.footnotes = {}
+        try:
+            if "fenced-code-blocks" in self.extras:
+                # Code holds no definitions, don't highlight it here.
+                block = self._fenced_code_block_re.sub("\n\n", block)
+            text = self._hash_raw_blocks(block)
+            if "footnotes" in self.extras:
+                text = self._strip_footnote_definitions(text)
+            self._strip_link_definitions(text)
+            return (tuple(self.urls.items()), tuple(self.titles.items()),
+                    tuple(self.footnotes.items()))
+        finally:
+            (self.urls, self.titles, self.html_blocks, self.html_spans,
+             self.footnotes) = state
+
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
         desired. This is called before unescaping of special chars and
@@ -368,7 +736,7 @@ class Markdown(object):
     #   foo: bar
     #   another-var: blah blah
     #   ---
-    _metadata_pat = re.compile("""^---[ \t]*\n((?:[ \t]*[^ \t:]+[ \t]*:[^\n]*\n)+)---[ \t]*\n""")
+    _metadata_pat = _lazy_re("""^---[ \t]*\n((?:[ \t]*[^ \t:]+[ \t]*:[^\n]*\n)+)---[ \t]*\n""")
 
     def _extract_metadata(self, text):
         # fast test
@@ -387,7 +755,7 @@ class Markdown(object):
         return tail
 
 
-    _emacs_oneliner_vars_pat = re.compile(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
+    _emacs_oneliner_vars_pat = _lazy_re(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
     # This regular expression is intended to match blocks like this:
     #    PREFIX Local Variables: SUFFIX
     #    PREFIX mode: Tcl SUFFIX
@@ -396,7 +764,7 @@ class Markdown(object):
     # - "[ \t]" is used instead of "\s" to specifically exclude newlines
     # - "(\r\n|\n|\r)" is used instead of "$" because the sre engine does
     #   not like anything other than Unix-style line terminators.
-    _emacs_local_vars_pat = re.compile(r"""^
+    _emacs_local_vars_pat = _lazy_re(r"""^
         (?P<prefix>(?:[^\r\n|\n|\r])*?)
         [\ \t]*Local\ Variables:[\ \t]*
         (?P<suffix>.*?)(?:\r\n|\n|\r)
@@ -503,12 +871,6 @@ class Markdown(object):
 
         return emacs_vars
 
-    # Cribbed from a post by Bart Lateur:
-    # <http://www.nntp.perl.org/group/perl.macperl.anyperl/154>
-    _detab_re = re.compile(r'(.*?)\t', re.M)
-    def _detab_sub(self, match):
-        g1 = match.group(1)
-        return g1 + (' ' * (self.tab_width - len(g1) % self.tab_width))
     def _detab(self, text):
         r"""Remove (leading?) tabs from a file.
             >>> m = Markdown()
@@ -525,7 +887,10 @@ class Markdown(object):
         """
         if '\t' not in text:
             return text
-        return self._detab_re.subn(self._detab_sub, text)[0]
+        # Same result as substituting r'(.*?)\t' line by line, but that
+        # regex rescans every tab-less line from each position: quadratic
+        # in the line length, and paragraphs are long lines.
+        return text.expandtabs(self.tab_width)
 
     # I broke out the html5 tags here and add them to _block_tags_a and
     # _block_tags_b.  This way html5 tags are easy to keep track of.
@@ -534,7 +899,7 @@ class Markdown(object):
     _block_tags_a = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math|ins|del'
     _block_tags_a += _html5tags
 
-    _strict_tag_block_re = re.compile(r"""
+    _strict_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -550,7 +915,7 @@ class Markdown(object):
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
     _block_tags_b += _html5tags
 
-    _liberal_tag_block_re = re.compile(r"""
+    _liberal_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -563,7 +928,7 @@ class Markdown(object):
         """ % _block_tags_b,
         re.X | re.M)
 
-    _html_markdown_attr_re = re.compile(
+    _html_markdown_attr_re = _lazy_re(
         r'''\s+markdown=("1"|'1')''')
     def _hash_html_block_sub(self, match, raw=False):
         html = match.group(1)
@@ -577,14 +942,14 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -677,7 +1042,7 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
 
@@ -697,28 +1062,9 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
         # Link defs are in the form:
         #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -729,10 +1075,12 @@ class Markdown(object):
             self.titles[key] = title
         return ""
 
+    _non_word_re = _lazy_re(r'\W')
+
     def _extract_footnote_def_sub(self, match):
         id, text = match.groups()
         text = _dedent(text, skip_first_line=not text.startswith('\n')).strip()
-        normed_id = re.sub(r'\W', '-', id)
+        normed_id = self._non_word_re.sub('-', id)
         # Ensure footnote text ends with a couple newlines (for some
         # block gamut matches).
         self.footnotes[normed_id] = text + "\n\n"
@@ -749,25 +1097,10 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
-    _hr_re = re.compile(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
+    _hr_re = _lazy_re(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
 
     def _run_block_gamut(self, text):
         # These are all the transformations that form block-level
@@ -784,7 +1117,7 @@ class Markdown(object):
         # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
         # hr chars to one or two. We'll reproduce that limit here.
         hr = "\n<hr"+self.empty_element_suffix+"\n"
-        text = re.sub(self._hr_re, hr, text)
+        text = self._hr_re.sub(hr, text)
 
         text = self._do_lists(text)
 
@@ -825,13 +1158,7 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
-
+        _pyshell_block_re = _pyshell_block_re_from_tab_width(self.tab_width)
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
     def _table_sub(self, match):
@@ -879,35 +1206,18 @@ class Markdown(object):
         """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
         https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
         """
-        less_than_tab = self.tab_width - 1
-        table_re = re.compile(r'''
-                (?:(?<=\n\n)|\A\n?)             # leading blank line
-                ^[ ]{0,%d}                      # allowed whitespace
-                (.*[|].*)  \n                   # $1: header row (at least one pipe)
-                ^[ ]{0,%d}                      # allowed whitespace
-                (                               # $2: underline row
-                    # underline row with leading bar
-                    (?:  \|\ *:?-+:?\ *  )+  \|?  \n
-                    |
-                    # or, underline row without leading bar
-                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
-                )
-                (                               # $3: data rows
-                    (?:
-                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
-                        .*\|.*  \n
-                    )+
-                )
-            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+        table_re = _table_re_from_tab_width(self.tab_width)
         return table_re.sub(self._table_sub, text)
 
+    _wiki_table_cell_re = _lazy_re(r'(?<!\\)\|\|')
+
     def _wiki_table_sub(self, match):
         ttext = match.group(0).strip()
         #print 'wiki table: %r' % match.group(0)
         rows = []
         for line in ttext.splitlines(0):
             line = line.strip()[2:-2].strip()
-            row = [c.strip() for c in re.split(r'(?<!\\)\|\|', line)]
+            row = [c.strip() for c in self._wiki_table_cell_re.split(line)]
             rows.append(row)
         #pprint(rows)
         hlines = ['<table>', '<tbody>']
@@ -927,14 +1237,12 @@ class Markdown(object):
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _wiki_table_re_from_tab_width(self.tab_width)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
+    _break_on_newline_re = _lazy_re(r" *\n")
+    _hard_break_re = _lazy_re(r" {2,}\n")
+
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
@@ -963,14 +1271,14 @@ class Markdown(object):
 
         # Do hard breaks:
         if "break-on-newline" in self.extras:
-            text = re.sub(r" *\n", "<br%s\n" % self.empty_element_suffix, text)
+            text = self._break_on_newline_re.sub("<br%s\n" % self.empty_element_suffix, text)
         else:
-            text = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix, text)
+            text = self._hard_break_re.sub(" <br%s\n" % self.empty_element_suffix, text)
 
         return text
 
     # "Sorta" because auto-links are identified as "tag" tokens.
-    _sorta_html_tokenize_re = re.compile(r"""
+    _sorta_html_tokenize_re = _lazy_re(r"""
         (
             # tag
             </?
@@ -1026,7 +1334,7 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1055,7 +1363,7 @@ class Markdown(object):
             raise MarkdownError("invalid value for 'safe_mode': %r (must be "
                                 "'escape' or 'replace')" % self.safe_mode)
 
-    _inline_link_title = re.compile(r'''
+    _inline_link_title = _lazy_re(r'''
             (                   # \1
               [ \t]+
               (['"])            # quote char = \2
@@ -1064,7 +1372,7 @@ class Markdown(object):
             )?                  # title is optional
           \)$
         ''', re.X | re.S)
-    _tail_of_reference_link_re = re.compile(r'''
+    _tail_of_reference_link_re = _lazy_re(r'''
           # Match tail of: [text][id]
           [ ]?          # one optional space
           (?:\n[ ]*)?   # one optional newline followed by spaces
@@ -1073,9 +1381,9 @@ class Markdown(object):
           \]
         ''', re.X | re.S)
 
-    _whitespace = re.compile(r'\s*')
+    _whitespace = _lazy_re(r'\s*')
 
-    _strip_anglebrackets = re.compile(r'<(.*)>.*')
+    _strip_anglebrackets = _lazy_re(r'<(.*)>.*')
 
     def _find_non_whitespace(self, text, start):
         """Returns the index of the first non-whitespace character in text
@@ -1181,7 +1489,7 @@ class Markdown(object):
 
             # Possibly a footnote ref?
             if "footnotes" in self.extras and link_text.startswith("^"):
-                normed_id = re.sub(r'\W', '-', link_text[1:])
+                normed_id = self._non_word_re.sub('-', link_text[1:])
                 if normed_id in self.footnotes:
                     self.footnote_ids.append(normed_id)
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
@@ -1317,7 +1625,9 @@ class Markdown(object):
             None to not have an id attribute and to exclude this header from
             the TOC (if the "toc" extra is specified).
         """
-        header_id = _slugify(text)
+        # Headers with no ASCII letters or digits, like Chinese ones, keep
+        # their own word characters rather than getting an empty id.
+        header_id = _slugify(text) or _slugify(text, ascii_only=False)
         if prefix and isinstance(prefix, base_string_type):
             header_id = prefix + '-' + header_id
         if header_id in self._count_from_header_id:
@@ -1346,8 +1656,8 @@ class Markdown(object):
         )
         '''
 
-    _h_re = re.compile(_h_re_base % '*', re.X | re.M)
-    _h_re_tag_friendly = re.compile(_h_re_base % '+', re.X | re.M)
+    _h_re = _lazy_re(_h_re_base % '*', re.X | re.M)
+    _h_re_tag_friendly = _lazy_re(_h_re_base % '+', re.X | re.M)
 
     def _h_sub(self, match):
         if match.group(1) is not None:
@@ -1417,33 +1727,8 @@ class Markdown(object):
             # types running into each other (see issue #16).
             hits = []
             for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
+                list_re = _list_re_from_tab_width(self.tab_width, marker_pat,
+                                                  bool(self.list_level))
                 match = list_re.search(text, pos)
                 if match:
                     hits.append((match.start(), match))
@@ -1458,7 +1743,7 @@ class Markdown(object):
 
         return text
 
-    _list_item_re = re.compile(r'''
+    _list_item_re = _lazy_re(r'''
         (\n)?                   # leading line = \1
         (^[ \t]*)               # leading whitespace = \2
         (?P<marker>%s) [ \t]+   # list marker = \3
@@ -1516,36 +1801,25 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        opts = _freeze(formatter_opts)
+        # The same snippet tends to come back: in re-rendered posts, in
+        # examples repeated across posts.
+        key = (lexer.__class__, opts, sha1(codeblock.encode("utf-8")).hexdigest())
+        try:
+            colored = highlight_cache.get(key)
+        except TypeError:
+            # uncachable -- for instance, a formatter option that is a set.
+            key = colored = None
+        if colored is None:
+            formatter = _html_code_formatter(opts)
+            colored = _import_pygments().highlight(codeblock, lexer, formatter)
+            if key is not None:
+                highlight_cache.put(key, colored)
+        return colored
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1611,23 +1885,10 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            # Lookahead to make sure this block isn't already in a code block.
-            # Needed when syntax highlighting is being used.
-            (?![^<]*\</code\>)
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
-    _fenced_code_block_re = re.compile(r'''
+    _fenced_code_block_re = _lazy_re(r'''
         (?:\n\n|\A\n?)
         ^```([\w+-]+)?[ \t]*\n      # opening fence, $1 = optional lang
         (.*?)                       # $2 = code block content
@@ -1649,7 +1910,7 @@ class Markdown(object):
     #   space and that space will be removed in the emitted HTML
     # See `test/tm-cases/escapes.text` for a number of edge-case
     # examples.
-    _code_span_re = re.compile(r'''
+    _code_span_re = _lazy_re(r'''
             (?<!\\)
             (`+)        # \1 = Opening run of `
             (?!`)       # See Note A test/tm-cases/escapes.text
@@ -1704,14 +1965,14 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
+        hashed = self._hash_text(text)
         self._escape_table[text] = hashed
         return hashed
 
-    _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
-    _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
-    _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
-    _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
+    _strong_re = _lazy_re(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
+    _em_re = _lazy_re(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
+    _code_friendly_strong_re = _lazy_re(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
+    _code_friendly_em_re = _lazy_re(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
     def _do_italics_and_bold(self, text):
         # <strong> must go first:
         if "code-friendly" in self.extras:
@@ -1726,7 +1987,7 @@ class Markdown(object):
     # apostrophe; e.g. ignores the fact that "round", "bout", "twer", and
     # "twixt" can be written without an initial apostrophe. This is fine because
     # using scare quotes (single quotation marks) is rare.
-    _apostrophe_year_re = re.compile(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
+    _apostrophe_year_re = _lazy_re(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
     _contractions = ["tis", "twas", "twer", "neath", "o", "n",
         "round", "bout", "twixt", "nuff", "fraid", "sup"]
     def _do_smart_contractions(self, text):
@@ -1738,10 +1999,10 @@ class Markdown(object):
         return text
 
     # Substitute double-quotes before single-quotes.
-    _opening_single_quote_re = re.compile(r"(?<!\S)'(?=\S)")
-    _opening_double_quote_re = re.compile(r'(?<!\S)"(?=\S)')
-    _closing_single_quote_re = re.compile(r"(?<=\S)'")
-    _closing_double_quote_re = re.compile(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
+    _opening_single_quote_re = _lazy_re(r"(?<!\S)'(?=\S)")
+    _opening_double_quote_re = _lazy_re(r'(?<!\S)"(?=\S)')
+    _closing_single_quote_re = _lazy_re(r"(?<=\S)'")
+    _closing_double_quote_re = _lazy_re(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
     def _do_smart_punctuation(self, text):
         """Fancifies 'single quotes', "double quotes", and apostrophes.
         Converts --, ---, and ... into en dashes, em dashes, and ellipses.
@@ -1767,7 +2028,7 @@ class Markdown(object):
         text = text.replace(". . .", "&#8230;")
         return text
 
-    _block_quote_re = re.compile(r'''
+    _block_quote_re = _lazy_re(r'''
         (                           # Wrap whole match in \1
           (
             ^[ \t]*>[ \t]?          # '>' at the start of a line
@@ -1777,11 +2038,13 @@ class Markdown(object):
           )+
         )
         ''', re.M | re.X)
-    _bq_one_level_re = re.compile('^[ \t]*>[ \t]?', re.M);
+    _bq_one_level_re = _lazy_re('^[ \t]*>[ \t]?', re.M);
 
-    _html_pre_block_re = re.compile(r'(\s*<pre>.+?</pre>)', re.S)
+    _html_pre_block_re = _lazy_re(r'(\s*<pre>.+?</pre>)', re.S)
+    _two_spaces_re = _lazy_re(r'(?m)^  ')
+    _line_start_re = _lazy_re('(?m)^')
     def _dedent_two_spaces_sub(self, match):
-        return re.sub(r'(?m)^  ', '', match.group(1))
+        return self._two_spaces_re.sub('', match.group(1))
 
     def _block_quote_sub(self, match):
         bq = match.group(1)
@@ -1789,7 +2052,7 @@ class Markdown(object):
         bq = self._ws_only_line_re.sub('', bq)  # trim whitespace-only lines
         bq = self._run_block_gamut(bq)          # recurse
 
-        bq = re.sub('(?m)^', '  ', bq)
+        bq = self._line_start_re.sub('  ', bq)
         # These leading spaces screw with <pre> content, so we need to fix that:
         bq = self._html_pre_block_re.sub(self._dedent_two_spaces_sub, bq)
 
@@ -1800,13 +2063,15 @@ class Markdown(object):
             return text
         return self._block_quote_re.sub(self._block_quote_sub, text)
 
+    _paragraph_split_re = _lazy_re(r"\n{2,}")
+
     def _form_paragraphs(self, text):
         # Strip leading and trailing lines:
         text = text.strip('\n')
 
         # Wrap <p> tags.
         grafs = []
-        for i, graf in enumerate(re.split(r"\n{2,}", text)):
+        for i, graf in enumerate(self._paragraph_split_re.split(text)):
             if graf in self.html_blocks:
                 # Unhashify HTML blocks
                 grafs.append(self.html_blocks[graf])
@@ -1867,9 +2132,9 @@ class Markdown(object):
 
     # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
     #   http://bumppo.net/projects/amputator/
-    _ampersand_re = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    _ampersand_re = _lazy_re(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
+    _naked_lt_re = _lazy_re(r'<(?![a-z/?\$!])', re.I)
+    _naked_gt_re = _lazy_re(r'''(?<![a-z0-9?!/'"-])>''', re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
@@ -1890,12 +2155,12 @@ class Markdown(object):
             text = text.replace("\\"+ch, escape)
         return text
 
-    _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
+    _auto_link_re = _lazy_re(r'<((https?|ftp):[^\'">\s]+)>', re.I)
     def _auto_link_sub(self, match):
         g1 = match.group(1)
         return '<a href="%s">%s</a>' % (g1, g1)
 
-    _auto_email_link_re = re.compile(r"""
+    _auto_email_link_re = _lazy_re(r"""
           <
            (?:mailto:)?
           (
@@ -1957,7 +2222,7 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
         for hash, link in list(link_from_hash.items()):
@@ -1990,6 +2255,40 @@ class MarkdownWithExtras(Markdown):
 
 #---- internal support functions
 
+def calculate_toc_html(toc):
+    """Return the HTML for a TOC, a list of (level, id, name) entries like
+    the "toc" extra collects, or None if `toc` is None. The entries can be
+    stored and turned into HTML later without converting the document.
+    """
+    if toc is None:
+        return None
+
+    def indent():
+        return '  ' * (len(h_stack) - 1)
+    lines = []
+    h_stack = [0]   # stack of header-level numbers
+    for level, id, name in toc:
+        if level > h_stack[-1]:
+            lines.append("%s<ul>" % indent())
+            h_stack.append(level)
+        elif level == h_stack[-1]:
+            lines[-1] += "</li>"
+        else:
+            while level < h_stack[-1]:
+                h_stack.pop()
+                if not lines[-1].endswith("</li>"):
+                    lines[-1] += "</li>"
+                lines.append("%s</ul></li>" % indent())
+        lines.append('%s<li><a href="#%s">%s</a>' % (
+            indent(), id, name))
+    while len(h_stack) > 1:
+        h_stack.pop()
+        if not lines[-1].endswith("</li>"):
+            lines[-1] += "</li>"
+        lines.append("%s</ul>" % indent())
+    return '\n'.join(lines) + '\n'
+
+
 class UnicodeWithAttrs(unicode):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
@@ -2001,46 +2300,24 @@ class UnicodeWithAttrs(unicode):
         """Return the HTML for the current TOC.
         This expects the `_toc` attribute to have been set on this instance.
         """
-        if self._toc is None:
-            return None
-
-        def indent():
-            return '  ' * (len(h_stack) - 1)
-        lines = []
-        h_stack = [0]   # stack of header-level numbers
-        for level, id, name in self._toc:
-            if level > h_stack[-1]:
-                lines.append("%s<ul>" % indent())
-                h_stack.append(level)
-            elif level == h_stack[-1]:
-                lines[-1] += "</li>"
-            else:
-                while level < h_stack[-1]:
-                    h_stack.pop()
-                    if not lines[-1].endswith("</li>"):
-                        lines[-1] += "</li>"
-                    lines.append("%s</ul></li>" % indent())
-            lines.append('%s<li><a href="#%s">%s</a>' % (
-                indent(), id, name))
-        while len(h_stack) > 1:
-            h_stack.pop()
-            if not lines[-1].endswith("</li>"):
-                lines[-1] += "</li>"
-            lines.append("%s</ul>" % indent())
-        return '\n'.join(lines) + '\n'
+        return calculate_toc_html(self._toc)
     toc_html = property(toc_html)
 
 ## {{{ http://code.activestate.com/recipes/577257/ (r1)
-_slugify_strip_re = re.compile(r'[^\w\s-]')
-_slugify_hyphenate_re = re.compile(r'[-\s]+')
-def _slugify(value):
+_slugify_strip_re = _lazy_re(r'[^\w\s-]')
+_slugify_hyphenate_re = _lazy_re(r'[-\s]+')
+def _slugify(value, ascii_only=True):
     """
     Normalizes string, converts to lowercase, removes non-alpha characters,
-    and converts spaces to hyphens.
+    and converts spaces to hyphens. Non-ASCII characters are dropped, unless
+    `ascii_only` is false.
     From Django's "django/template/defaultfilters.py".
     """
     import unicodedata
-    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode()
+    if ascii_only:
+        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode()
+    else:
+        value = unicodedata.normalize('NFKC', value)
     value = _slugify_strip_re.sub('', value).strip().lower()
     return _slugify_hyphenate_re.sub('-', value)
 ## end of http://code.activestate.com/recipes/577257/ }}}
@@ -2167,30 +2444,7 @@ def _dedent(text, tabsize=8, skip_first_line=False):
     return ''.join(lines)
 
 
-class _memoized(object):
-   """Decorator that caches a function's return value each time it is called.
-   If called later with the same arguments, the cached value is returned, and
-   not re-evaluated.
-   http://wiki.python.org/moin/PythonDecoratorLibrary
-   """
-   def __init__(self, func):
-      self.func = func
-      self.cache = {}
-   def __call__(self, *args):
-      try:
-         return self.cache[args]
-      except KeyError:
-         self.cache[args] = value = self.func(*args)
-         return value
-      except TypeError:
-         # uncachable -- for instance, passing a list as an argument.
-         # Better to not cache than to blow up entirely.
-         return self.func(*args)
-   def __repr__(self):
-      """Return the function's docstring."""
-      return self.func.__doc__
-
-
+@memoize(16)
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
     return re.compile(r"""
@@ -2210,8 +2464,8 @@ def _xml_oneliner_re_from_tab_width(tab_width):
             (?=\n{2,}|\Z)       # followed by a blank line or end of document
         )
         """ % (tab_width - 1), re.X)
-_xml_oneliner_re_from_tab_width = _memoized(_xml_oneliner_re_from_tab_width)
 
+@memoize(16)
 def _hr_tag_re_from_tab_width(tab_width):
      return re.compile(r"""
         (?:
@@ -2229,7 +2483,189 @@ def _hr_tag_re_from_tab_width(tab_width):
             (?=\n{2,}|\Z)       # followed by a blank line or end of document
         )
         """ % (tab_width - 1), re.X)
-_hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
+
+@memoize(16)
+def _outdent_re_from_tab_width(tab_width):
+    return re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+
+@memoize(16)
+def _link_def_re_from_tab_width(tab_width):
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+
+@memoize(16)
+def _footnote_def_re_from_tab_width(tab_width):
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+
+@memoize(16)
+def _pyshell_block_re_from_tab_width(tab_width):
+    return re.compile(r"""
+        ^([ ]{0,%d})>>>[ ].*\n   # first line
+        ^(\1.*\S+.*\n)*         # any number of subsequent lines
+        ^\n                     # ends with a blank line
+        """ % (tab_width - 1), re.M | re.X)
+
+@memoize(16)
+def _table_re_from_tab_width(tab_width):
+    less_than_tab = tab_width - 1
+    return re.compile(r'''
+            (?:(?<=\n\n)|\A\n?)             # leading blank line
+            ^[ ]{0,%d}                      # allowed whitespace
+            (.*[|].*)  \n                   # $1: header row (at least one pipe)
+            ^[ ]{0,%d}                      # allowed whitespace
+            (                               # $2: underline row
+                # underline row with leading bar
+                (?:  \|\ *:?-+:?\ *  )+  \|?  \n
+                |
+                # or, underline row without leading bar
+                (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
+            )
+            (                               # $3: data rows
+                (?:
+                    ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
+                    .*\|.*  \n
+                )+
+            )
+        ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+
+@memoize(16)
+def _wiki_table_re_from_tab_width(tab_width):
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+        (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+        ''' % (tab_width - 1), re.M | re.X)
+
+@memoize(64)
+def _list_re_from_tab_width(tab_width, marker_pat, sub_list):
+    """Regex for a whole list with the given marker, `sub_list` anchors it
+    at any line start instead of after a blank line.
+    """
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+            (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (tab_width - 1, marker_pat, marker_pat)
+    if sub_list:
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list, re.X | re.M | re.S)
+
+@memoize(16)
+def _code_block_re_from_tab_width(tab_width):
+    return re.compile(r'''
+        (?:\n\n|\A\n?)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        # Lookahead to make sure this block isn't already in a code block.
+        # Needed when syntax highlighting is being used.
+        (?![^<]*\</code\>)
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+
+
+# Pygments is only imported when the first code block is highlighted.
+# Lexers and formatters are created once and shared.
+_pygments = None
+
+def _import_pygments():
+    """Return the pygments module, or None if it isn't installed."""
+    global _pygments
+    if _pygments is None:
+        try:
+            import pygments
+            import pygments.lexers
+            import pygments.formatters
+            import pygments.util
+        except ImportError:
+            pygments = False
+        _pygments = pygments
+    return _pygments or None
+
+@memoize(128)
+def _pygments_lexer(lexer_name):
+    pygments = _import_pygments()
+    if pygments is None:
+        return None
+    try:
+        return pygments.lexers.get_lexer_by_name(lexer_name)
+    except pygments.util.ClassNotFound:
+        return None
+
+@memoize(1)
+def _html_code_formatter_class():
+    pygments = _import_pygments()
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            yield 0, "<code>"
+            for tup in inner:
+                yield tup
+            yield 0, "</code>"
+
+        def wrap(self, source, outfile=None):
+            """Return the source with a code, pre, and div."""
+            return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+    return HtmlCodeFormatter
+
+@memoize(32)
+def _html_code_formatter(opts):
+    """A formatter for the (name, value) pairs of `opts`."""
+    return _html_code_formatter_class()(**dict(opts))
 
 
 def _xml_escape_attr(attr, skip_single_quote=True):
@@ -2264,11 +2700,6 @@ def _xml_encode_email_char_at_random(ch):
 
 #---- mainline
 
-class _NoReflowFormatter(optparse.IndentedHelpFormatter):
-    """An optparse formatter that does NOT reflow the description."""
-    def format_description(self, description):
-        return description or ""
-
 def _test():
     import doctest
     doctest.testmod()
@@ -2279,6 +2710,12 @@ def main(argv=None):
     if not logging.root.handlers:
         logging.basicConfig()
 
+    import optparse
+    class _NoReflowFormatter(optparse.IndentedHelpFormatter):
+        """An optparse formatter that does NOT reflow the description."""
+        def format_description(self, description):
+            return description or ""
+
     usage = "usage: %prog [PATHS...]"
     version = "%prog "+__version__
     parser = optparse.OptionParser(prog="markdown2", usage=usage,
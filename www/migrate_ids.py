@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Rewrite the legacy 50-character ids ('%015d%s000' % (timestamp, uuid4 hex))
+of blogs and comments as compact snowflake ids, keeping their millisecond
+timestamp so the order of ids does not change, then shrink the id columns.
+The old blog ids are kept in legacy_blog_ids, so get_blog redirects the
+old permalinks; run sync_schema.py --apply first to create that table.
+
+User ids are kept as they are: password hashes are salted with the user id,
+new users get compact ids anyway.
+
+Usage: python3 migrate_ids.py [--apply]
+'''
+
+import sys
+import asyncio
+
+import orm
+from models import Comment, LegacyBlogId, ID_EPOCH, ID_LENGTH, WORKER_BITS, SEQUENCE_BITS, encode_id
+from config import configs
+
+def legacy_to_id(old, used):
+	' derive a snowflake id from a legacy id: its timestamp, and worker and sequence bits from its uuid. '
+	ms = max(int(old[:15]), ID_EPOCH)
+	h = int(old[15:47], 16)
+	n = ((ms - ID_EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (h & ((1 << (WORKER_BITS + SEQUENCE_BITS)) - 1))
+	while n in used:
+		n += 1
+	used.add(n)
+	return encode_id(n)
+
+async def legacy_ids(table):
+	async with orm.connection():
+		rs = await orm.select('select `id` from `%s` where length(`id`)>?' % table, [ID_LENGTH], tuples=True)
+	return [r[0] for r in rs]
+
+async def migrate(loop, apply):
+	await orm.create_pool(loop=loop, **configs.db)
+	used = set()
+	blogs = await legacy_ids('blogs')
+	comments = await legacy_ids('comments')
+	print('legacy ids: %s blogs, %s comments.' % (len(blogs), len(comments)))
+	if not apply:
+		print('run with --apply to rewrite them.')
+		return
+	for old in blogs:
+		new = legacy_to_id(old, used)
+		async with orm.transaction():
+			await orm.execute('update `blogs` set `id`=? where `id`=?', [new, old])
+			await orm.execute('update `comments` set `blog_id`=? where `blog_id`=?', [new, old])
+			await LegacyBlogId(id=old, blog_id=new).save()
+	for old in comments:
+		await orm.execute('update `comments` set `id`=? where `id`=?', [legacy_to_id(old, used), old])
+	# 剩下的长blog_id属于早已删除的博客
+	orphans = await Comment.delete_where('length(`blog_id`)>?', [ID_LENGTH])
+	print('deleted %s orphan comments.' % orphans)
+	for table, column in (('blogs', 'id'), ('comments', 'id'), ('comments', 'blog_id')):
+		await orm.execute('alter table `%s` modify `%s` varchar(%d) not null' % (table, column, ID_LENGTH), None)
+	print('done.')
+
+
+if __name__ == '__main__':
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(migrate(loop, '--apply' in sys.argv[1:]))
@@ -3,16 +3,93 @@
 
 __author__ = 'Ten Tsang'
 
+import os
 import time
-import uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField
+import threading
+from orm import Model, Index, StringField, BooleanField, FloatField, CompressedTextField, JSONField
+
+# snowflake风格的64位ID：41位毫秒时间戳 + 10位worker编号 + 12位毫秒内序号
+ID_EPOCH = 1420070400000  # 2015-01-01 00:00:00 UTC
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+ID_LENGTH = 13  # 36 ** 13 > 2 ** 63
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def encode_id(n):
+	'''
+	Encode a 64-bit id as a fixed width base36 string. Only lowercase letters
+	are used, so ids compare the same under case-insensitive collations, and
+	the fixed width keeps string order equal to numeric order.
+	'''
+	s = []
+	for i in range(ID_LENGTH):
+		n, r = divmod(n, 36)
+		s.append(_DIGITS[r])
+	return ''.join(reversed(s))
+
+def decode_id(s):
+	return int(s, 36)
+
+def worker_id():
+	'''
+	The worker number of this process, read from the WORKER_ID environment
+	variable (0-1023). Every process creating ids needs its own number: one
+	derived from the process id could repeat and produce duplicate ids.
+	'''
+	value = os.environ.get('WORKER_ID', None)
+	if value is None:
+		raise RuntimeError('WORKER_ID is not set: give every process a distinct number from 0 to %d.' % ((1 << WORKER_BITS) - 1))
+	worker = int(value)
+	if not 0 <= worker < (1 << WORKER_BITS):
+		raise ValueError('WORKER_ID must be a number from 0 to %d: %s' % ((1 << WORKER_BITS) - 1, value))
+	return worker
+
+class IdGenerator(object):
+	'''
+	Generate time ordered 64-bit ids. Every process must use a distinct worker
+	number, by default the one worker_id() reads from WORKER_ID. A process
+	forked after its parent generated ids would share the parent's worker
+	number, so it refuses to generate any.
+	'''
+
+	def __init__(self, worker=None):
+		self._worker = worker
+		self._lock = threading.Lock()
+		self._pid = None
+
+	def _reset(self):
+		if self._pid is not None:
+			raise RuntimeError('worker %s was used by process %s before the fork: give every process its own WORKER_ID.' % (self.worker, self._pid))
+		self._pid = os.getpid()
+		self.worker = worker_id() if self._worker is None else self._worker
+		self._last = 0
+		self._sequence = 0
+
+	def next(self):
+		with self._lock:
+			if self._pid != os.getpid():
+				self._reset()
+			# 时钟回拨时继续使用上一次的时间戳，保证ID单调递增
+			now = max(int(time.time() * 1000), self._last)
+			if now == self._last:
+				self._sequence = (self._sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+				if self._sequence == 0:
+					# 同一毫秒内的序号用完，借用下一毫秒
+					now += 1
+			else:
+				self._sequence = 0
+			self._last = now
+			return ((now - ID_EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker << SEQUENCE_BITS) | self._sequence
+
+_ids = IdGenerator()
 
 def next_id():
-	return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+	return encode_id(_ids.next())
 
 
 class User(Model):
 	__table__ = 'users'
+	__indexes__ = (Index('email', unique=True), 'created_at')
 	
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
 	email = StringField(ddl='varchar(50)')
@@ -25,28 +102,48 @@ class User(Model):
 
 class Blog(Model):
 	__table__ = 'blogs'
+	# 删除博客时分批删除它的评论和旧ID
+	__cascade__ = (('Comment', 'blog_id'), ('LegacyBlogId', 'blog_id'))
+	__indexes__ = ('created_at',)
 	
-	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+	id = StringField(primary_key=True, default=next_id, ddl='varchar(13)')
 	user_id = StringField(ddl='varchar(50)')
 	user_name = StringField(ddl='varchar(50)')
 	user_image = StringField(ddl='varchar(500)')
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
-	content = TextField()
+	content = CompressedTextField()
+	# 保存时生成的目录：[[level, id, name], ...]，见handlers.blog_toc()
+	toc = JSONField()
 	created_at = FloatField(default=time.time)
 
 
 class Comment(Model):
 	__table__ = 'comments'
+	# get_blog按blog_id查询并按created_at排序
+	__indexes__ = ('created_at', ('blog_id', 'created_at'))
 	
-	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	blog_id = StringField(ddl='varchar(50)')
+	id = StringField(primary_key=True, default=next_id, ddl='varchar(13)')
+	blog_id = StringField(ddl='varchar(13)')
 	user_id = StringField(ddl='varchar(50)')
 	user_name = StringField(ddl='varchar(50)')
 	user_image = StringField(ddl='varchar(500)')
-	content = TextField()
+	content = CompressedTextField()
+	# 写入时由text2html()生成
+	html_content = CompressedTextField()
 	created_at = FloatField(default=time.time)
 
+class LegacyBlogId(Model):
+	'''
+	The 50-character id a blog had before migrate_ids.py gave it a compact
+	one, so get_blog can redirect its old permalinks.
+	'''
+	__table__ = 'legacy_blog_ids'
+	__indexes__ = ('blog_id',)
+
+	id = StringField(primary_key=True, ddl='varchar(50)')
+	blog_id = StringField(ddl='varchar(13)')
+
 """
 在编写ORM时，给一个Field增加一个default参数可以让ORM自己填入缺省值，非常方便。并且，缺省值可以作为函数对象传入，在调用save()时自动计算。
 例如，主键id的缺省值是函数next_id，创建时间created_at的缺省值是函数time.time，可以自动设置当前日期和时间。
@@ -3,18 +3,31 @@
 
 __author__ = 'Ten Tsang'
 
+import re
+import sys
+import time
+import random
 import asyncio
 import logging
+import zlib
+import json
+import contextvars
 import aiomysql
 
+from cache import LRUCache
+
 def log(sql, args=()):
 	logging.info('SQL: %s' % sql)
-	logging.info('Args: %s' % args)
+	logging.info('Args: %s' % (args,))
 
-async def create_pool(loop, **kw):
-	logging.info('create database connection pool...')
-	global __pool
-	__pool = await aiomysql.create_pool(
+async def _create_pool(loop, **kw):
+	minsize = kw.get('minsize', 1)
+	maxsize = kw.get('maxsize', 10)
+	# budget是数据库端允许本应用使用的连接总数，由所有worker进程平分
+	budget = kw.get('budget', None)
+	if budget:
+		maxsize = max(minsize, min(maxsize, budget // kw.get('workers', 1)))
+	pool = await aiomysql.create_pool(
 		host=kw.get('host', 'localhost'),
 		port=kw.get('port', 3306),
 		user=kw['user'],
@@ -22,23 +35,266 @@ async def create_pool(loop, **kw):
 		db=kw['database'],
 		charset=kw.get('charset', 'utf8'),
 		autocommit=kw.get('autocommit', True),
-		maxsize=kw.get('maxsize', 10),
-		minsize=kw.get('minsize', 1),
+		maxsize=maxsize,
+		minsize=minsize,
 		loop=loop
 	)
+	if kw.get('adaptive', False):
+		pool = AdaptivePool(pool, minsize, maxsize, **kw.get('tuning', {}))
+	return pool
+
+async def create_pool(loop, **kw):
+	logging.info('create database connection pool...')
+	global __pool, __replicas, __stickiness, _batch
+	replicas = kw.pop('replicas', None) or []
+	__pool = await _create_pool(loop, **kw)
+	__replicas = []
+	for r in replicas:
+		# 只读副本未指定的配置项沿用主库的配置
+		conf = dict(kw, **r)
+		logging.info('create replica connection pool: %s:%s' % (conf.get('host', 'localhost'), conf.get('port', 3306)))
+		__replicas.append(Replica(await _create_pool(loop, **conf), conf.get('eject', 30)))
+	__stickiness = kw.get('stickiness', 5)
+	_batch = kw.get('batch', True)
+	enable_advisor(kw.get('advisor', False))
+
+class AdaptivePool(object):
+	'''
+	Wrap an aiomysql pool and tune how many connections may be in use at once.
+
+	The limit grows by `step` as soon as an acquire() has queued for `grow_wait`
+	seconds, so a burst reaches maxsize within a few waits, and shrinks by `step`
+	only after `cooldown` consecutive `interval` windows whose peak utilization
+	stayed below `shrink_usage`. The limit never leaves [minsize, maxsize], so
+	maxsize is the hard per-worker budget. The shrinking runs on a timer, so an
+	idle worker shrinks too.
+	'''
+
+	def __init__(self, pool, minsize, maxsize, grow_wait=0.005, shrink_usage=0.5, interval=10, cooldown=6, step=1):
+		self._pool = pool
+		# aiomysql允许minsize=0（不预先建立连接），但上限至少为1，否则acquire()永远等待
+		self.minsize = max(1, minsize)
+		self.maxsize = max(self.minsize, maxsize)
+		self.limit = self.minsize
+		self.grow_wait = grow_wait
+		self.shrink_usage = shrink_usage
+		self.interval = interval
+		self.cooldown = cooldown
+		self.step = step
+		self._cond = asyncio.Condition()
+		self._in_use = 0
+		self._idle_windows = 0
+		self._reset_window()
+		self._tuner = asyncio.ensure_future(self._run_tuner())
+
+	def _reset_window(self):
+		self._peak = self._in_use
+
+	@property
+	def size(self):
+		return self._pool.size
+
+	@property
+	def freesize(self):
+		return self._pool.freesize
+
+	def get(self):
+		return _AdaptiveConnection(self)
+
+	async def acquire(self):
+		async with self._cond:
+			while self._in_use >= self.limit:
+				if self.limit >= self.maxsize:
+					await self._cond.wait()
+					continue
+				try:
+					await asyncio.wait_for(self._cond.wait(), self.grow_wait)
+				except asyncio.TimeoutError:
+					# 排队超过grow_wait说明连接不够用，立即扩容，不等下一个窗口
+					self._grow()
+			self._in_use += 1
+		try:
+			conn = await self._pool.acquire()
+		except BaseException:
+			await self._free_slot()
+			raise
+		self._peak = max(self._peak, self._in_use)
+		return conn
+
+	async def release(self, conn):
+		await self._pool.release(conn)
+		await self._free_slot()
+
+	async def _free_slot(self):
+		async with self._cond:
+			self._in_use -= 1
+			self._cond.notify()
+
+	async def _run_tuner(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			try:
+				await self._tune()
+			except Exception as e:
+				logging.exception(e)
+
+	async def _close_idle(self, n):
+		' close n idle connections: take them out of the pool and give them back closed. '
+		for i in range(n):
+			if self._pool.freesize == 0:
+				break
+			conn = await self._pool.acquire()
+			conn.close()
+			await self._pool.release(conn)
+
+	def _grow(self):
+		' raise the limit by step, called with the condition held. '
+		limit = min(self.maxsize, self.limit + self.step)
+		logging.info('resize connection pool: %s => %s (acquire waited over %ss)' % (self.limit, limit, self.grow_wait))
+		self.limit = limit
+		self._idle_windows = 0
+		self._cond.notify_all()
 
-async def select(sql, args, size=None):
+	async def _tune(self):
+		' shrink the limit after cooldown idle windows, run every interval seconds. '
+		usage = self._peak / self.limit if self.limit else 0.0
+		limit = self.limit
+		if usage < self.shrink_usage and limit > self.minsize:
+			self._idle_windows += 1
+			if self._idle_windows >= self.cooldown:
+				limit = max(self.minsize, limit - self.step)
+				self._idle_windows = 0
+		else:
+			self._idle_windows = 0
+		self._reset_window()
+		if limit == self.limit:
+			return
+		logging.info('resize connection pool: %s => %s (usage: %.2f)' % (self.limit, limit, usage))
+		self.limit = limit
+		if self._pool.freesize > limit - self._in_use:
+			# 只关闭超出新上限的空闲连接，其余的继续复用
+			await self._close_idle(self._pool.freesize - (limit - self._in_use))
+
+	def close(self):
+		self._tuner.cancel()
+		self._pool.close()
+
+	async def wait_closed(self):
+		await self._pool.wait_closed()
+
+class _AdaptiveConnection(object):
+
+	def __init__(self, pool):
+		self._pool = pool
+		self._conn = None
+
+	async def __aenter__(self):
+		self._conn = await self._pool.acquire()
+		return self._conn
+
+	async def __aexit__(self, exc_type, exc, tb):
+		conn, self._conn = self._conn, None
+		await self._pool.release(conn)
+
+__replicas = []
+__stickiness = 5
+_primary_until = contextvars.ContextVar('primary_until', default=0.0)
+
+class Replica(object):
+	'''
+	A read-only replica pool, ejected from routing for `eject` seconds after a connection error.
+	'''
+
+	def __init__(self, pool, eject=30):
+		self.pool = pool
+		self.eject = eject
+		self.active = 0
+		self.ejected_until = 0.0
+
+	@property
+	def healthy(self):
+		return self.ejected_until <= time.time()
+
+	def fail(self, e):
+		logging.warning('eject replica for %ss: %s' % (self.eject, e))
+		self.ejected_until = time.time() + self.eject
+
+def stick_to_primary(until=None):
+	'''
+	Route reads of the current request to the primary until the given timestamp,
+	by default for `stickiness` seconds from now.
+	'''
+	if until is None:
+		until = time.time() + __stickiness
+	if until > _primary_until.get():
+		_primary_until.set(until)
+
+def primary_until():
+	return _primary_until.get()
+
+def _choose_replica():
+	if not __replicas or _primary_until.get() > time.time():
+		return None
+	candidates = [r for r in __replicas if r.healthy]
+	if not candidates:
+		return None
+	# 选择正在执行查询最少的副本，相同时随机选择
+	least = min(r.active for r in candidates)
+	return random.choice([r for r in candidates if r.active == least])
+
+# 客户端的连接错误：连不上服务器、连接断开等。服务器返回的错误（>=1000）与副本是否可用无关
+_CONNECTION_ERRNOS = frozenset([2002, 2003, 2005, 2006, 2013, 2055])
+
+def _is_connection_error(e):
+	' whether e means the server could not be reached, as opposed to an error of the query. '
+	if isinstance(e, (OSError, asyncio.TimeoutError)):
+		return True
+	return isinstance(e, aiomysql.OperationalError) and bool(e.args) and e.args[0] in _CONNECTION_ERRNOS
+
+async def _fetch(conn, sql, args, size, cursor=aiomysql.DictCursor):
+	async with conn.cursor(cursor) as cur:
+		await cur.execute(sql.replace('?', '%s'), args or ())
+		if size:
+			rs = await cur.fetchmany(size)
+		else:
+			rs = await cur.fetchall()
+	return rs
+
+async def _select(pool, sql, args, size, cursor):
+	async with pool.get() as conn:
+		return await _fetch(conn, sql, args, size, cursor)
+
+async def select(sql, args, size=None, tuples=False):
+	' return rows as dicts, or as plain tuples in column order if tuples is True. '
 	log(sql, args)
+	cursor = aiomysql.Cursor if tuples else aiomysql.DictCursor
 	global __pool
-	async with __pool.get() as conn:
-		async with conn.cursor(aiomysql.DictCursor) as cur:
-			await cur.execute(sql.replace('?', '%s'), args or ())
-			if size:
-				rs = await cur.fetchmany(size)
-			else:
-				rs = await cur.fetchall()
+	pinned = _connection.get()
+	if pinned is not None:
+		try:
+			rs = await _fetch(pinned.conn, sql, args, size, cursor)
+		except Exception as e:
+			if pinned.replica is not None and _is_connection_error(e):
+				pinned.replica.fail(e)
+			raise
 		logging.info('rows returned: %s' % len(rs))
 		return rs
+	replica = _choose_replica()
+	if replica is None:
+		rs = await _select(__pool, sql, args, size, cursor)
+	else:
+		replica.active += 1
+		try:
+			rs = await _select(replica.pool, sql, args, size, cursor)
+		except Exception as e:
+			if not _is_connection_error(e):
+				raise
+			replica.fail(e)
+			rs = await _select(__pool, sql, args, size, cursor)
+		finally:
+			replica.active -= 1
+	logging.info('rows returned: %s' % len(rs))
+	return rs
 
 """
 SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换。
@@ -47,6 +303,16 @@ SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部
 
 async def execute(sql, args, autocommit=True):
 	log(sql)
+	pinned = _connection.get()
+	if pinned is not None:
+		if pinned.readonly:
+			raise RuntimeError('Cannot execute %s in a read-only connection block.' % sql)
+		# 由connection()负责事务的开始和提交
+		async with pinned.conn.cursor(aiomysql.DictCursor) as cur:
+			await cur.execute(sql.replace('?', '%s'), args)
+			affected = cur.rowcount
+		stick_to_primary()
+		return affected
 	async with __pool.get() as conn:
 		if not autocommit:
 			await conn.begin()
@@ -60,7 +326,339 @@ async def execute(sql, args, autocommit=True):
 			if not autocommit:
 				await conn.rollback()
 			raise
-		return affected
+	# 写入之后的短时间内读主库，保证能读到自己刚写入的数据
+	stick_to_primary()
+	return affected
+
+_connection = contextvars.ContextVar('connection', default=None)
+
+def _primary_pool():
+	return __pool
+
+class connection(object):
+	'''
+	Pin one pooled connection to the current task for the duration of an
+	`async with` block, so that select(), execute() and all Model methods
+	inside the block share it:
+
+		async with orm.connection(transaction=True):
+			blog = await Blog.find(id)
+			await blog.update()
+
+	With transaction=True the block is committed on success and rolled back
+	on error. With readonly=True a replica connection may be used and writes
+	are rejected; a replica that cannot be connected to is ejected and the
+	primary is used instead, like select() does. Nested blocks join the
+	outermost one. Do not run queries of one block concurrently (e.g. via
+	asyncio.gather), a connection can only serve one statement at a time.
+	'''
+
+	def __init__(self, transaction=False, readonly=False):
+		self.transaction = transaction and not readonly
+		self.readonly = readonly
+		self.conn = None
+		self.replica = None
+		self._pool = None
+		self._token = None
+
+	async def _acquire(self):
+		replica = _choose_replica() if self.readonly else None
+		if replica is not None:
+			# 整个代码块都算作副本上正在执行的查询
+			replica.active += 1
+			try:
+				self.conn = await replica.pool.acquire()
+				self._pool = replica.pool
+				self.replica = replica
+				return
+			except Exception as e:
+				replica.active -= 1
+				if not _is_connection_error(e):
+					raise
+				replica.fail(e)
+		self._pool = _primary_pool()
+		self.conn = await self._pool.acquire()
+
+	async def _release(self):
+		conn, self.conn = self.conn, None
+		try:
+			await self._pool.release(conn)
+		finally:
+			if self.replica is not None:
+				self.replica.active -= 1
+				self.replica = None
+
+	async def __aenter__(self):
+		if _connection.get() is not None:
+			return _connection.get().conn
+		await self._acquire()
+		try:
+			if self.transaction:
+				await self.conn.begin()
+		except BaseException:
+			await self._release()
+			raise
+		self._token = _connection.set(self)
+		return self.conn
+
+	async def __aexit__(self, exc_type, exc, tb):
+		if self._token is None:
+			return
+		_connection.reset(self._token)
+		self._token = None
+		try:
+			if self.transaction:
+				if exc_type is None:
+					await self.conn.commit()
+				else:
+					await self.conn.rollback()
+					# 回滚后已加载的对象可能与数据库不一致
+					m = _identity.get()
+					if m is not None:
+						m.clear()
+		finally:
+			await self._release()
+
+def transaction():
+	return connection(transaction=True)
+
+_identity = contextvars.ContextVar('identity', default=None)
+
+class IdentityMap(object):
+	'''
+	Request-scoped cache of loaded Model objects keyed by class and primary key,
+	plus the results of findAll() keyed by SQL and args. A row is represented by
+	one object per request; writes through Model methods keep it up to date.
+	'''
+
+	def __init__(self):
+		self.objects = {}
+		self.queries = {}
+
+	def get(self, cls, pk):
+		return self.objects.get((cls, pk), None)
+
+	def add(self, obj):
+		' register obj and return the object representing its row. '
+		key = (obj.__class__, obj.getValue(obj.__primary_key__))
+		return self.objects.setdefault(key, obj)
+
+	def replace(self, obj):
+		self.objects[(obj.__class__, obj.getValue(obj.__primary_key__))] = obj
+
+	def discard(self, cls, pk):
+		self.objects.pop((cls, pk), None)
+
+	def evict(self, cls):
+		' drop every object and cached query of cls. '
+		for key in [k for k in self.objects if k[0] is cls]:
+			del self.objects[key]
+		self.invalidate(cls)
+
+	def invalidate(self, cls):
+		' drop cached findAll() results of cls, whose rows have changed. '
+		for key in [k for k in self.queries if k[0] is cls]:
+			del self.queries[key]
+
+	def clear(self):
+		self.objects.clear()
+		self.queries.clear()
+
+class identity_map(object):
+	'''
+	Enable an IdentityMap for the current task inside a `with` block. Nested
+	blocks share the outermost map.
+	'''
+
+	def __init__(self):
+		self._token = None
+
+	def __enter__(self):
+		m = _identity.get()
+		if m is None:
+			m = IdentityMap()
+			self._token = _identity.set(m)
+		return m
+
+	def __exit__(self, exc_type, exc, tb):
+		if self._token is not None:
+			_identity.reset(self._token)
+			self._token = None
+
+def detach(obj):
+	' remove obj from the current identity map, e.g. before masking its fields. '
+	m = _identity.get()
+	if m is not None and m.get(obj.__class__, obj.getValue(obj.__primary_key__)) is obj:
+		m.discard(obj.__class__, obj.getValue(obj.__primary_key__))
+
+_batch = False
+
+class _Loader(object):
+	'''
+	Coalesce the find() calls of one model made by concurrent coroutines in the
+	same event loop iteration into a single `in (...)` query.
+	'''
+
+	def __init__(self, cls, loop):
+		self.cls = cls
+		self.loop = loop
+		self.pending = {}
+
+	def load(self, pk):
+		fut = self.pending.get(pk, None)
+		if fut is None:
+			if not self.pending:
+				# 在空的上下文中执行，避免批量查询使用某个请求的连接或identity map
+				self.loop.call_soon(self._dispatch, context=contextvars.Context())
+			fut = self.pending[pk] = self.loop.create_future()
+		return fut
+
+	def _dispatch(self):
+		pending, self.pending = self.pending, {}
+		self.loop.create_task(self._fetch(pending))
+
+	async def _fetch(self, pending):
+		try:
+			rows = await self.cls._select_many(list(pending.keys()))
+		except BaseException as e:
+			for fut in pending.values():
+				if not fut.done():
+					fut.set_exception(e)
+			return
+		for pk, fut in pending.items():
+			if not fut.done():
+				fut.set_result(rows.get(pk, None))
+
+_loaders = {}
+
+def _loader(cls):
+	loop = asyncio.get_event_loop()
+	loader = _loaders.get(cls, None)
+	if loader is None or loader.loop is not loop:
+		loader = _loaders[cls] = _Loader(cls, loop)
+	return loader
+
+def create_table_sql(cls):
+	' build the `create table` statement of a model from its field DDL and __indexes__. '
+	lines = ['`%s` %s not null' % (cls.__mappings__[f].name or f, cls.__mappings__[f].column_type) for f in cls.__slots__]
+	lines.extend(index.ddl() for index in cls.__indexes__)
+	lines.append('primary key (`%s`)' % cls.__primary_key__)
+	return 'create table `%s` (\n\t%s\n) engine=innodb default charset=utf8' % (cls.__table__, ',\n\t'.join(lines))
+
+async def sync_schema(models, apply=False):
+	'''
+	Compare the live schema with the models and return the statements that
+	create missing tables, add missing columns and add missing indexes.
+	Indexes are matched by their columns, not by name. The statements are
+	executed if apply is True. Existing columns and indexes are never changed
+	or dropped.
+	'''
+	statements = []
+	async with connection():
+		rs = await select('select table_name from information_schema.tables where table_schema=database()', [], tuples=True)
+		tables = set(r[0] for r in rs)
+		for cls in models:
+			if cls.__table__ not in tables:
+				statements.append(create_table_sql(cls))
+				continue
+			rs = await select('select column_name from information_schema.columns where table_schema=database() and table_name=?', [cls.__table__], tuples=True)
+			columns = set(r[0] for r in rs)
+			for f in cls.__slots__:
+				column = cls.__mappings__[f].name or f
+				if column not in columns:
+					statements.append('alter table `%s` add column `%s` %s not null' % (cls.__table__, column, cls.__mappings__[f].column_type))
+			rs = await select('select index_name, column_name from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', [cls.__table__], tuples=True)
+			existing = {}
+			for index_name, column in rs:
+				existing.setdefault(index_name, []).append(column)
+			existing = set(tuple(c) for c in existing.values())
+			for index in cls.__indexes__:
+				if index.columns not in existing:
+					statements.append('alter table `%s` add %s' % (cls.__table__, index.ddl()))
+		if apply:
+			for sql in statements:
+				await execute(sql, None)
+	return statements
+
+async def check_binary_columns(models):
+	'''
+	Raise RuntimeError if a CompressedTextField of models is still stored in a
+	text column. Compressed values cannot be written to such a column, so the
+	columns must be converted (see compress_text.py) before the app starts.
+	'''
+	problems = []
+	async with connection():
+		for cls in models:
+			columns = [cls.__mappings__[f].name or f for f in cls.__slots__ if isinstance(cls.__mappings__[f], CompressedTextField)]
+			if not columns:
+				continue
+			rs = await select('select column_name, data_type from information_schema.columns where table_schema=database() and table_name=?', [cls.__table__], tuples=True)
+			types = dict((r[0], r[1].lower()) for r in rs)
+			for column in columns:
+				if column in types and not types[column].endswith('blob'):
+					problems.append('`%s`.`%s` is %s' % (cls.__table__, column, types[column]))
+	if problems:
+		raise RuntimeError('compressed text stored in text columns: %s. Run compress_text.py --apply first.' % ', '.join(problems))
+
+_advisor = None
+
+def enable_advisor(enabled=True):
+	'''
+	Diagnostic mode: run EXPLAIN once for every distinct SQL shape issued by
+	find(), findAll() and findNumber(), and remember their call sites. Plans
+	with a full table scan, a filesort or a temporary table are logged as
+	warnings and listed by advisor_report(). Meant for staging benchmarks.
+	'''
+	global _advisor
+	_advisor = {} if enabled else None
+
+def advisor_report():
+	' return the advice of the queries whose plan has problems, worst first. '
+	if _advisor is None:
+		return []
+	advice = [a for a in _advisor.values() if a['problems']]
+	advice.sort(key=lambda a: -a['rows'])
+	return advice
+
+_in_list_re = re.compile(r'\bin \((?:\?, )*\?\)')
+
+def _normalize_sql(sql):
+	return _in_list_re.sub('in (...)', ' '.join(sql.split()))
+
+def _call_site():
+	' the first frame outside orm.py, i.e. the code that called the Model method. '
+	f = sys._getframe(1)
+	while f is not None and f.f_code.co_filename == __file__:
+		f = f.f_back
+	return '%s:%s' % (f.f_code.co_filename, f.f_lineno) if f is not None else '<unknown>'
+
+async def _advise(sql, args, site):
+	key = _normalize_sql(sql)
+	advice = _advisor.get(key, None)
+	if advice is not None:
+		advice['call_sites'].add(site)
+		return
+	advice = _advisor[key] = dict(sql=key, call_sites=set([site]), problems=[], rows=0, plan=[])
+	try:
+		plan = await select('explain ' + sql, args)
+	except Exception as e:
+		logging.warning('explain failed: %s: %s' % (key, e))
+		return
+	problems = []
+	for r in plan:
+		r = dict((k.lower(), v) for k, v in r.items())
+		extra = r.get('extra') or ''
+		if r.get('type') == 'ALL':
+			problems.append('full scan of %s' % r.get('table'))
+		if 'Using filesort' in extra:
+			problems.append('filesort on %s' % r.get('table'))
+		if 'Using temporary' in extra:
+			problems.append('temporary table for %s' % r.get('table'))
+		advice['rows'] += r.get('rows') or 0
+	advice['plan'] = plan
+	advice['problems'] = problems
+	if problems:
+		logging.warning('query advisor: %s: %s (called from %s)' % (key, ', '.join(problems), site))
 
 def create_args_string(num):
 	L = []
@@ -70,6 +668,12 @@ def create_args_string(num):
 
 class Field(object):
 
+	# 可选的转换函数：to_db把Python值转换为写入数据库的值，from_db反之
+	to_db = None
+	from_db = None
+	# 可变的值（如list）在加载时的快照不能与字段共用同一个对象，snapshot返回用于比较的副本
+	snapshot = None
+
 	def __init__(self, name, column_type, primary_key, default):
 		self.name = name
 		self.column_type = column_type
@@ -104,6 +708,102 @@ class TextField(Field):
 	def __init__(self, name=None, default=None):
 		super().__init__(name, 'text', False, default)
 
+class CompressedTextField(Field):
+	'''
+	Text stored in a blob column, zlib compressed when the UTF-8 encoding is at
+	least `threshold` bytes long and compression actually saves space. The first
+	byte is a format marker, 0 for raw UTF-8 and 1 for zlib. Values without a
+	marker are read as legacy text, so a text column can be converted to a
+	blob first and its rows compressed afterwards (see compress_text.py).
+	The column must be a blob before the field writes to it, which
+	check_binary_columns() verifies at startup.
+	'''
+
+	RAW = b'\x00'
+	ZLIB = b'\x01'
+
+	def __init__(self, name=None, default=None, threshold=512, level=6, ddl='mediumblob'):
+		super().__init__(name, ddl, False, default)
+		self.threshold = threshold
+		self.level = level
+
+	def to_db(self, value):
+		if value is None:
+			return None
+		data = value.encode('utf-8')
+		if len(data) >= self.threshold:
+			compressed = zlib.compress(data, self.level)
+			if len(compressed) < len(data):
+				return self.ZLIB + compressed
+		return self.RAW + data
+
+	def from_db(self, value):
+		if value is None:
+			return None
+		if isinstance(value, str):
+			# 仍是文本列时，读到的是字符串：去掉raw标记
+			return value[1:] if value[:1] == '\x00' else value
+		marker = value[:1]
+		if marker == self.ZLIB:
+			return zlib.decompress(value[1:]).decode('utf-8')
+		if marker == self.RAW:
+			return bytes(value[1:]).decode('utf-8')
+		return bytes(value).decode('utf-8')
+
+class JSONField(Field):
+	'''
+	A list or dict stored as JSON text. An empty column, which is what a column
+	added to a table holds in the existing rows, reads as None.
+	'''
+
+	def __init__(self, name=None, default=None, ddl='text'):
+		super().__init__(name, ddl, False, default)
+
+	def to_db(self, value):
+		if value is None:
+			return None
+		return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+	def from_db(self, value):
+		if not value:
+			return None
+		if isinstance(value, (bytes, bytearray)):
+			value = value.decode('utf-8')
+		return json.loads(value)
+
+	# 以JSON文本作为快照，原地修改list或dict后也能发现变化
+	snapshot = to_db
+
+class Index(object):
+	'''
+	An index declared in a model's __indexes__, e.g.
+
+		__indexes__ = ('created_at', ('blog_id', 'created_at'), Index('email', unique=True))
+
+	A plain field name or a tuple of field names is turned into an Index.
+	'''
+
+	def __init__(self, *columns, unique=False, name=None):
+		self.columns = tuple(columns)
+		self.unique = unique
+		self.name = name or 'idx_%s' % '_'.join(columns)
+
+	def ddl(self):
+		return '%skey `%s` (%s)' % ('unique ' if self.unique else '', self.name, ', '.join('`%s`' % c for c in self.columns))
+
+	def __str__(self):
+		return '<%s %s>' % (self.__class__.__name__, self.ddl())
+
+def _index(spec):
+	if isinstance(spec, Index):
+		return spec
+	if isinstance(spec, str):
+		return Index(spec)
+	return Index(*spec)
+
+# 所有Model子类，按类名索引，用于解析__cascade__中的模型名
+_models = {}
+
 class ModelMetaclass(type):
 
 	# __new__ 是在__init__之前被调用的特殊方法
@@ -143,28 +843,163 @@ class ModelMetaclass(type):
 		attrs['__table__'] = tableName
 		attrs['__primary_key__'] = primaryKey  # 主键属性名
 		attrs['__fields__'] = fields  # 除主键外的属性名
+		attrs['__indexes__'] = [_index(i) for i in attrs.get('__indexes__', ())]
+		for index in attrs['__indexes__']:
+			for c in index.columns:
+				if c not in mappings:
+					raise ValueError('Invalid column in index %s of %s: %s' % (index.name, name, c))
 		# 构建默认的SELECT，INSERT，UPDATE和DELETE语句
 		attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
 		attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
 		attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
 		attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-		return type.__new__(cls, name, bases, attrs)
+		# 每个字段对应一个slot，实例不再是dict，省去__getattr__的查找开销和dict的内存
+		attrs['__slots__'] = tuple([primaryKey] + fields)
+		attrs['__init__'] = _make_init([primaryKey] + fields)
+		model = type.__new__(cls, name, bases, attrs)
+		# 按__select__的列顺序直接从tuple构造实例，不经过中间dict和**kw
+		model.__from_row__ = staticmethod(_make_from_row(model, mappings, [primaryKey] + fields))
+		# 为save()和update()生成专用的参数构造函数，按__insert__和__update__的参数顺序取值
+		model.__insert_args__ = _make_insert_args(mappings, fields + [primaryKey])
+		model.__update_args__ = _make_update_args(mappings, fields + [primaryKey])
+		model.__values__ = _make_values(mappings, [primaryKey] + fields)
+		# 每种脏字段组合一条update语句，只保留最近用到的
+		model.__update_variants__ = LRUCache(64, name='orm.%s.update_sql' % name)
+		_models[name] = model
+		return model
 # 这样，任何继承自Model的类，会自动通过ModelMetaclass扫描映射关系，并存储到自身的类属性，如__table__、__mappings__中
 # 然后，我们往Model类添加class方法，就可以让所有子类调用class方法
 
-class Model(dict, metaclass=ModelMetaclass):
+def _compile(name, source, namespace):
+	exec(source, namespace)
+	return namespace[name]
 
-	def __init__(self, **kw):
-		super(Model, self).__init__(**kw)
-	
-	def __getattr__(self, key):
+def _make_init(names):
+	' generate __init__(self, f1=None, f2=None, ..., **kw) assigning every field slot. '
+	lines = ['def __init__(self, %s, **kw):' % ', '.join('%s=None' % n for n in names)]
+	lines.extend('\tself.%s = %s' % (n, n) for n in names)
+	lines.append('\tself._loaded = None')
+	lines.append('\tif kw:')
+	lines.append('\t\tself.__dict__.update(kw)')
+	return _compile('__init__', '\n'.join(lines), {})
+
+def _converters(mappings, names, attr):
+	' return a namespace of the to_db/from_db converters of names, keyed c0, c1... by position. '
+	namespace = {}
+	for i, n in enumerate(names):
+		convert = getattr(mappings[n], attr)
+		if convert is not None:
+			namespace['c%d' % i] = convert
+	return namespace
+
+def _make_from_row(cls, mappings, names):
+	' generate from_row(row) building a cls instance from a row in __select__ column order. '
+	namespace = _converters(mappings, names, 'from_db')
+	lines = ['def from_row(row):', '\tself = new(cls)']
+	lines.append('\t%s, = row' % ', '.join('self.%s' % n for n in names))
+	for i, n in enumerate(names):
+		if 'c%d' % i in namespace:
+			lines.append('\tself.%s = c%d(self.%s)' % (n, i, n))
+	if namespace:
+		snapshots = _snapshots(mappings, names)
+		lines.append('\tself._loaded = (%s,)' % ', '.join(_snapshot_expr(snapshots, i, n) for i, n in enumerate(names)))
+		namespace.update(snapshots)
+	else:
+		lines.append('\tself._loaded = row')
+	lines.append('\treturn self')
+	namespace.update(new=object.__new__, cls=cls)
+	return _compile('from_row', '\n'.join(lines), namespace)
+
+def _make_insert_args(mappings, names):
+	'''
+	generate insert_args(self) returning the values of names, filling and storing
+	the field default (called if callable) for every value that is None.
+	'''
+	namespace = _converters(mappings, names, 'to_db')
+	lines = ['def insert_args(self):']
+	for i, n in enumerate(names):
+		default = mappings[n].default
+		lines.append('\tv%d = self.%s' % (i, n))
+		if default is None:
+			continue
+		namespace['d%d' % i] = default
+		lines.append('\tif v%d is None:' % i)
+		lines.append('\t\tv%d = self.%s = d%d%s' % (i, n, i, '()' if callable(default) else ''))
+	values = [('c%d(v%d)' % (i, i)) if 'c%d' % i in namespace else 'v%d' % i for i in range(len(names))]
+	lines.append('\treturn [%s]' % ', '.join(values))
+	return _compile('insert_args', '\n'.join(lines), namespace)
+
+def _make_update_args(mappings, names):
+	' generate update_args(self) returning the values of names, converted for the database. '
+	namespace = _converters(mappings, names, 'to_db')
+	values = [('c%d(self.%s)' % (i, n)) if 'c%d' % i in namespace else 'self.%s' % n for i, n in enumerate(names)]
+	source = 'def update_args(self):\n\treturn [%s]' % ', '.join(values)
+	return _compile('update_args', source, namespace)
+
+def _to_db(cls, name, value):
+	convert = cls.__mappings__[name].to_db
+	return value if convert is None else convert(value)
+
+def _snapshot(cls, name, value):
+	convert = cls.__mappings__[name].snapshot
+	return value if convert is None else convert(value)
+
+def _snapshots(mappings, names):
+	' return a namespace of the snapshot functions of names, keyed s0, s1... by position. '
+	return dict(('s%d' % i, mappings[n].snapshot) for i, n in enumerate(names) if mappings[n].snapshot is not None)
+
+def _snapshot_expr(snapshots, i, n):
+	return ('s%d(self.%s)' % (i, n)) if 's%d' % i in snapshots else 'self.%s' % n
+
+def _make_values(mappings, names):
+	'''
+	generate values(self) returning a tuple of the fields in __select__ column
+	order, as snapshots for the fields that take one, to be kept in _loaded.
+	'''
+	snapshots = _snapshots(mappings, names)
+	source = 'def values(self):\n\treturn (%s,)' % ', '.join(_snapshot_expr(snapshots, i, n) for i, n in enumerate(names))
+	return _compile('values', source, snapshots)
+
+class Model(metaclass=ModelMetaclass):
+	'''
+	Base class of all models. Fields are stored in slots generated by
+	ModelMetaclass, other attributes (e.g. html_content set by handlers) go to
+	the instance __dict__. Instances also behave as a read-only mapping of
+	fields and extra attributes, so dict(obj) gives a JSON-ready dict.
+	'''
+
+	# _loaded保存从数据库加载或最近一次写入时各字段的值，用于计算哪些字段被修改过
+	__slots__ = ('__dict__', '_loaded')
+
+	def keys(self):
+		return list(self.__slots__) + list(self.__dict__)
+
+	def __getitem__(self, key):
 		try:
-			return self[key]
-		except KeyError:
-			raise AttributeError(r"'Model' object has no attribute '%s'" % key)
-	
-	def __setattr__(self, key, value):
-		self[key] = value
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		setattr(self, key, value)
+
+	def __contains__(self, key):
+		return key in self.__mappings__ or key in self.__dict__
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.__slots__) + len(self.__dict__)
+
+	def get(self, key, default=None):
+		return getattr(self, key, default)
+
+	def items(self):
+		return [(k, getattr(self, k)) for k in self.keys()]
+
+	def __repr__(self):
+		return '<%s %r>' % (self.__class__.__name__, dict(self.items()))
 	
 	def getValue(self, key):
 		return getattr(self, key, None)
@@ -208,8 +1043,18 @@ class Model(dict, metaclass=ModelMetaclass):
 			else:
 				raise ValueError('Invalid limit value: %s' % str(limit))
 		logging.info('Args in findAll(orm): %s' % args)
-		rs = await select(' '.join(sql), args)
-		return [cls(**r) for r in rs]
+		if _advisor is not None:
+			await _advise(' '.join(sql), args, _call_site())
+		m = _identity.get()
+		if m is None:
+			rs = await select(' '.join(sql), args, tuples=True)
+			return list(map(cls.__from_row__, rs))
+		key = (cls, ' '.join(sql), tuple(args))
+		objs = m.queries.get(key, None)
+		if objs is None:
+			rs = await select(' '.join(sql), args, tuples=True)
+			objs = m.queries[key] = [m.add(cls.__from_row__(r)) for r in rs]
+		return list(objs)
 	
 	@classmethod
 	async def findNumber(cls, selectField, where=None, args=None):
@@ -218,39 +1063,217 @@ class Model(dict, metaclass=ModelMetaclass):
 		if where:
 			sql.append('where')
 			sql.append(where)
-		rs = await select(' '.join(sql), args, 1)
+		if _advisor is not None:
+			await _advise(' '.join(sql), args, _call_site())
+		rs = await select(' '.join(sql), args, 1, tuples=True)
 		if len(rs) == 0:
 			return None
-		return rs[0]['_num_']
+		return rs[0][0]
 	
 	@classmethod
 	async def find(cls, pk):
 		' find object by primary key. '
-		rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-		if len(rs) == 0:
-			return None
-		return cls(**rs[0])
+		m = _identity.get()
+		if m is not None:
+			obj = m.get(cls, pk)
+			if obj is not None:
+				return obj
+		if _advisor is not None:
+			await _advise('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], _call_site())
+		if _batch and _connection.get() is None and _primary_until.get() <= time.time():
+			# 同一个future由所有等待者共享，一个请求被取消时不能连带取消其他请求
+			r = await asyncio.shield(_loader(cls).load(pk))
+			if r is None:
+				return None
+		else:
+			rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1, tuples=True)
+			if len(rs) == 0:
+				return None
+			r = rs[0]
+		obj = cls.__from_row__(r)
+		return obj if m is None else m.add(obj)
+
+	@classmethod
+	async def _select_many(cls, pks, chunk=500):
+		'''
+		load rows as tuples by primary keys, return a dict of requested primary
+		key => row. The keys are joined as a derived table, so a key the database
+		matches under its collation or type coercion maps to its row as in find().
+		'''
+		rows = {}
+		for i in range(0, len(pks), chunk):
+			part = pks[i:i + chunk]
+			# 每个键带上它在part中的位置，结果中的位置指明这一行对应哪个请求的键
+			keys = ' union all '.join('select %d as `__i`, ? as `__k`' % n for n in range(len(part)))
+			sql = 'select `__i`, %s join (%s) `__keys` on `%s`=`__k`' % (cls.__select__[len('select '):], keys, cls.__primary_key__)
+			for r in await select(sql, part, tuples=True):
+				rows[part[r[0]]] = r[1:]
+		return rows
+
+	@classmethod
+	async def find_many(cls, pks, chunk=500):
+		' find objects by primary keys in chunked `in` queries, return a list aligned with pks. '
+		m = _identity.get()
+		found = {}
+		missing = []
+		for pk in pks:
+			if pk in found:
+				continue
+			found[pk] = m.get(cls, pk) if m is not None else None
+			if found[pk] is None:
+				missing.append(pk)
+		if missing:
+			rows = await cls._select_many(missing, chunk)
+			for pk, r in rows.items():
+				obj = cls.__from_row__(r)
+				found[pk] = obj if m is None else m.add(obj)
+		return [found.get(pk, None) for pk in pks]
 	
 	async def save(self):
-		# logging.info(self)
-		# logging.info(self.__fields__)
-		args = list(map(self.getValueOrDefault, self.__fields__))
-		# logging.info(args)
-		args.append(self.getValueOrDefault(self.__primary_key__))
+		args = self.__insert_args__()
 		rows = await execute(self.__insert__, args)
 		if rows != 1:
 			logging.warn('failed to insert record: affected rows: %s' % rows)
+		self._loaded = self.__values__()
+		self._sync_identity()
+
+	def dirty_fields(self):
+		' names of the fields changed since the object was loaded or written, None if unknown. '
+		if self._loaded is None:
+			return None
+		names = self.__class__.__slots__
+		return [names[i] for i, (old, new) in enumerate(zip(self._loaded, self.__values__())) if old != new]
+
+	@classmethod
+	def _update_sql(cls, names):
+		sql = cls.__update_variants__.get(names)
+		if sql is None:
+			mappings = cls.__mappings__
+			sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join('`%s`=?' % (mappings[f].name or f) for f in names), cls.__primary_key__)
+			cls.__update_variants__.put(names, sql)
+		return sql
 	
 	async def update(self):
-		args = list(map(self.getValue, self.__fields__))
-		args.append(self.getValue(self.__primary_key__))
-		rows = await execute(self.__update__, args)
+		' write the changed fields only, or every field if the object was not loaded from the database. '
+		dirty = self.dirty_fields()
+		if dirty is None:
+			args = self.__update_args__()
+			rows = await execute(self.__update__, args)
+		else:
+			dirty = tuple(f for f in dirty if f != self.__primary_key__)
+			if not dirty:
+				logging.debug('nothing to update for %s' % self.getValue(self.__primary_key__))
+				return
+			args = [_to_db(self.__class__, f, getattr(self, f)) for f in dirty]
+			# 主键以加载时的值为准
+			args.append(self._loaded[0])
+			rows = await execute(self._update_sql(dirty), args)
 		if rows != 1:
 			logging.warn('failed to update by primary key: affected rows: %s' % rows)
+		self._loaded = self.__values__()
+		self._sync_identity()
 	
+	@classmethod
+	async def update_where(cls, pk, expected_version=None, **fields):
+		'''
+		update fields of the row with primary key pk in one statement, without
+		loading it first. If the model names an integer version column in
+		__version_field__ and expected_version is given, the row is only updated
+		when its version still matches, and the version is incremented.
+		Return the affected rows.
+		'''
+		names = tuple(fields)
+		if not names:
+			raise ValueError('No fields to update for %s.' % cls.__name__)
+		for name in names:
+			if name not in cls.__fields__:
+				raise ValueError('Invalid field for %s: %s' % (cls.__name__, name))
+		sql = cls._update_sql(names)
+		args = [_to_db(cls, n, fields[n]) for n in names]
+		args.append(pk)
+		version = getattr(cls, '__version_field__', None)
+		if version and expected_version is not None:
+			key = (names, version)
+			sql = cls.__update_variants__.get(key)
+			if sql is None:
+				sql = cls._update_sql(names).replace(' where ', ', `%s`=`%s`+1 where ' % (version, version), 1) + ' and `%s`=?' % version
+				cls.__update_variants__.put(key, sql)
+			args.append(expected_version)
+		rows = await execute(sql, args)
+		m = _identity.get()
+		if m is not None:
+			obj = m.get(cls, pk)
+			if obj is not None:
+				if rows == 0:
+					m.discard(cls, pk)
+				else:
+					if version and expected_version is not None:
+						fields[version] = expected_version + 1
+					loaded = list(obj._loaded) if obj._loaded is not None else None
+					for name, value in fields.items():
+						setattr(obj, name, value)
+						if loaded is not None:
+							loaded[cls.__slots__.index(name)] = _snapshot(cls, name, value)
+					if loaded is not None:
+						obj._loaded = tuple(loaded)
+			m.invalidate(cls)
+		return rows
+
+	@classmethod
+	async def delete_where(cls, where, args=None, chunk=1000):
+		'''
+		delete rows by where clause in chunks of at most `chunk` rows, so a big
+		delete never holds its locks for long. Return the total affected rows.
+		'''
+		sql = 'delete from `%s` where %s limit ?' % (cls.__table__, where)
+		args = list(args or [])
+		total = 0
+		while True:
+			rows = await execute(sql, args + [chunk])
+			total += rows
+			if rows < chunk:
+				break
+		m = _identity.get()
+		if m is not None:
+			m.evict(cls)
+		return total
+
+	@classmethod
+	async def _delete_cascade(cls, pk):
+		'''
+		delete the rows referencing pk as declared in __cascade__, a sequence of
+		(model name, foreign key field) pairs, e.g. (('Comment', 'blog_id'),).
+		'''
+		for name, fk in getattr(cls, '__cascade__', ()):
+			rows = await _models[name].delete_where('`%s`=?' % fk, [pk])
+			logging.info('cascade delete %s rows of %s' % (rows, name))
+
+	@classmethod
+	async def delete_by_pk(cls, pk):
+		' delete the row with primary key pk (and its __cascade__ rows first), return the affected rows. '
+		await cls._delete_cascade(pk)
+		rows = await execute(cls.__delete__, [pk])
+		m = _identity.get()
+		if m is not None:
+			m.discard(cls, pk)
+			m.invalidate(cls)
+		return rows
+
 	async def remove(self):
 		args = [self.getValue(self.__primary_key__)]
+		await self._delete_cascade(args[0])
 		rows = await execute(self.__delete__, args)
 		if rows != 1:
 			logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+		self._sync_identity(removed=True)
+
+	def _sync_identity(self, removed=False):
+		m = _identity.get()
+		if m is None:
+			return
+		if removed:
+			m.discard(self.__class__, self.getValue(self.__primary_key__))
+		else:
+			m.replace(self)
+		m.invalidate(self.__class__)
 
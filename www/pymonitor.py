@@ -40,7 +40,10 @@ def kill_process():
 def start_process():
 	global process, command
 	log('Start process %s...' % ' '.join(command))
-	process = subprocess.Popen(command, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
+	# 开发时只运行一个进程，未设置WORKER_ID时使用0
+	env = dict(os.environ)
+	env.setdefault('WORKER_ID', '0')
+	process = subprocess.Popen(command, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr, env=env)
 
 def restart_process():
 	kill_process()
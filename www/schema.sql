@@ -20,26 +20,36 @@ create table users(
 )engine=innodb default charset=utf8;
 
 create table blogs(
-	`id` varchar(50) not null,
+	`id` varchar(13) not null,
 	`user_id` varchar(50) not null,
 	`user_name` varchar(50) not null,
 	`user_image` varchar(500) not null,
 	`name` varchar(50) not null,
 	`summary` varchar(200) not null,
-	`content` mediumtext not null,
+	`content` mediumblob not null,
+	`toc` text not null,
 	`created_at` real not null,
 	key `idx_created_at` (`created_at`),
 	primary key (`id`)
 )engine=innodb default charset=utf8;
 
 create table comments(
-	`id` varchar(50) not null,
-	`blog_id` varchar(50) not null,
+	`id` varchar(13) not null,
+	`blog_id` varchar(13) not null,
 	`user_id` varchar(50) not null,
 	`user_name` varchar(50) not null,
 	`user_image` varchar(500) not null,
-	`content` mediumtext not null,
+	`content` mediumblob not null,
+	`html_content` mediumblob not null,
 	`created_at` real not null,
 	key `idx_created_at` (`created_at`),
+	key `idx_blog_id_created_at` (`blog_id`, `created_at`),
 	primary key (`id`)
-)engine=innodb default charset=utf8;
\ No newline at end of file
+)engine=innodb default charset=utf8;
+
+create table legacy_blog_ids(
+	`id` varchar(50) not null,
+	`blog_id` varchar(13) not null,
+	key `idx_blog_id` (`blog_id`),
+	primary key (`id`)
+)engine=innodb default charset=utf8;
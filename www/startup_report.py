@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Report the import time of the modules a worker loads before it binds, per
+module, from the output of python -X importtime. Each module is imported in
+a fresh interpreter several times and the fastest run is kept.
+
+Usage: python3 startup_report.py [--runs N] [--top N] [--save FILE] [--compare FILE] [modules...]
+'''
+
+import os
+import re
+import sys
+import json
+import subprocess
+
+# app.py启动服务器，所以只导入它在绑定端口前加载的模块
+MODULES = ['handlers']
+
+_line_re = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+def import_times(module, cwd):
+	' {name: (self us, cumulative us, depth)} of one import of module in a fresh interpreter. '
+	p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+	if p.returncode != 0:
+		raise RuntimeError('import %s failed:\n%s' % (module, p.stderr.strip().splitlines()[-1]))
+	times = {}
+	for line in p.stderr.splitlines():
+		m = _line_re.match(line)
+		if m:
+			times[m.group(4)] = (int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2)
+	return times
+
+def measure(module, runs, cwd):
+	' the fastest of runs imports, after one run that writes the bytecode caches. '
+	import_times(module, cwd)
+	best = None
+	for i in range(runs):
+		times = import_times(module, cwd)
+		if best is None or times[module][1] < best[module][1]:
+			best = times
+	return best
+
+def local_modules(cwd):
+	return set(os.path.splitext(f)[0] for f in os.listdir(cwd) if f.endswith('.py'))
+
+def report(module, times, top, local):
+	print('%s: %.1f ms' % (module, times[module][1] / 1000))
+	print('  %-40s %10s %10s' % ('slowest imports', 'self ms', 'total ms'))
+	for name, (own, total, depth) in sorted(times.items(), key=lambda t: -t[1][0])[:top]:
+		print('  %-40s %10.1f %10.1f' % (name, own / 1000, total / 1000))
+	print('  %-40s %10s %10s' % ('modules of this app', 'self ms', 'total ms'))
+	for name, (own, total, depth) in sorted(times.items(), key=lambda t: -t[1][1]):
+		if name.split('.')[0] in local:
+			print('  %-40s %10.1f %10.1f' % (name, own / 1000, total / 1000))
+
+def compare(results, path):
+	with open(path) as f:
+		old = json.load(f)
+	print('compared with %s:' % path)
+	for module, times in results.items():
+		if module not in old:
+			continue
+		before, after = old[module][module][1], times[module][1]
+		print('  %-40s %8.1f ms -> %8.1f ms (%+.0f%%)' % (module, before / 1000, after / 1000, (after - before) * 100.0 / before))
+		# 新增或变慢最多的模块
+		grown = [(times[n][1] - (old[module][n][1] if n in old[module] else 0), n) for n in times if times[n][2] == 1]
+		for delta, name in sorted(grown, reverse=True)[:5]:
+			if delta > 0:
+				print('    %-38s %+8.1f ms' % (name, delta / 1000))
+
+def main():
+	args = sys.argv[1:]
+	options = dict(runs=5, top=15, save=None, compare=None)
+	modules = []
+	while args:
+		arg = args.pop(0)
+		if arg.startswith('--') and arg[2:] in options:
+			options[arg[2:]] = args.pop(0)
+		else:
+			modules.append(arg)
+	cwd = os.path.dirname(os.path.abspath(__file__))
+	local = local_modules(cwd)
+	results = {}
+	for module in modules or MODULES:
+		try:
+			results[module] = measure(module, int(options['runs']), cwd)
+		except RuntimeError as e:
+			print(e)
+			continue
+		report(module, results[module], int(options['top']), local)
+	if options['compare']:
+		compare(results, options['compare'])
+	if options['save']:
+		with open(options['save'], 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+		print('saved to %s' % options['save'])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ten Tsang'
+
+'''
+Compare the database schema with the models and print the statements that
+add missing tables, columns and indexes.
+
+Usage: python3 sync_schema.py [--apply]
+'''
+
+import sys
+import asyncio
+
+import orm
+from models import User, Blog, Comment, LegacyBlogId
+from config import configs
+
+async def sync(loop, apply):
+	await orm.create_pool(loop=loop, **configs.db)
+	statements = await orm.sync_schema([User, Blog, Comment, LegacyBlogId], apply=apply)
+	if not statements:
+		print('schema is up to date.')
+	for sql in statements:
+		print('%s;' % sql)
+	if statements and not apply:
+		print('run with --apply to execute the statements above.')
+
+
+if __name__ == '__main__':
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(sync(loop, '--apply' in sys.argv[1:]))